@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import sys
+import json
+import time
+import gzip
+import shlex
+import shutil
+import platform
+import argparse
+import itertools
+import subprocess
+
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulate import simulate, hamming
+
+
+def run_cmd(cmd):
+    s = time.time()
+    with open(os.devnull, "w") as devnull:
+        p = subprocess.Popen(cmd, stdout=devnull, stderr=subprocess.PIPE)
+        err = p.stderr.read()
+        _, status, ru = os.wait4(p.pid, 0)
+        p.returncode = status
+    elapse = time.time() - s
+    if status:
+        raise RuntimeError("%s failed:\n%s" % (" ".join(cmd), err.decode()))
+    return elapse, ru.ru_maxrss
+
+
+def expected_sample(truth, barcode, mis):
+    bcs = []
+    with open(barcode) as fi:
+        for line in fi:
+            line = line.split()
+            bcs.append((line[0], line[1], len(line) > 2 and line[2] or line[1]))
+    paired = None
+    exp = {}
+    with open(truth) as fi:
+        for line in fi:
+            name, origin, a, b = line.rstrip("\n").split("\t")
+            if paired is None:
+                paired = bool(b)
+            d = [hamming(a, bc1) for sn, bc1, bc2 in bcs]
+            best = min(d)
+            sn = "Unknow"
+            if best <= mis and d.count(best) == 1:
+                i = d.index(best)
+                sn = bcs[i][0]
+                if paired:
+                    d2 = [hamming(b, bc2) for _, _, bc2 in bcs]
+                    best2 = min(d2)
+                    hit = [bcs[j][2] for j, v in enumerate(d2) if v == best2]
+                    if not (best2 <= mis and len(set(hit)) == 1 and hit[0] == bcs[i][2]):
+                        sn = "Unknow"
+            exp[name] = sn
+    return exp
+
+
+def read_names(path):
+    op = path.endswith(".gz") and gzip.open or open
+    with op(path, "rb") as fi:
+        for n, line in enumerate(fi):
+            if n % 4 == 0:
+                yield line[1:].split()[0].decode()
+
+
+def check_outputs(outdir, expect, paired):
+    got = {}
+    for f in os.listdir(outdir):
+        if not (f.endswith(".fq") or f.endswith(".fq.gz")) or ".R2." in f:
+            continue
+        sn = f.split(".")[0]
+        for name in read_names(os.path.join(outdir, f)):
+            got[name] = sn
+    wrong = sum(1 for name, sn in expect.items()
+                if got.get(name, "Unknow") != sn)
+    return {"correct": wrong == 0, "misassigned": wrong,
+            "assigned": len(got), "expected": Counter(expect.values())}
+
+
+def input_bytes(path):
+    if path.endswith(".gz"):
+        n = 0
+        with gzip.open(path, "rb") as fi:
+            for b in iter(lambda: fi.read(1 << 20), b""):
+                n += len(b)
+        return n
+    return os.path.getsize(path)
+
+
+def bench_split(fsplit, data, workdir, mis, threads, engine, gz_out, qc, paired, reads, nbytes, check):
+    outdir = os.path.join(workdir, "split")
+    if os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    cmd = fsplit + ["split", "-i", data["fq1"], "-b", data["barcode"],
+                    "-o", outdir, "-m", str(mis), "-t", str(threads), "--engine", engine]
+    if paired:
+        cmd += ["-I", data["fq2"]]
+    if gz_out:
+        cmd.append("--output-gzip")
+    if qc:
+        cmd.append("--qc")
+    elapse, rss = run_cmd(cmd)
+    res = {"command": "split", "mismatch": mis, "threads": threads, "engine": engine,
+           "output_gzip": gz_out, "qc": qc, "elapse": round(elapse, 3), "peak_rss_kb": rss,
+           "reads_per_sec": round(reads / elapse, 1),
+           "mb_per_sec": round(nbytes / 1048576.0 / elapse, 2)}
+    if check:
+        res.update(check_outputs(outdir, expected_sample(
+            data["truth"], data["barcode"], mis), paired))
+    return res
+
+
+def bench_index(fsplit, data, reads, nbytes):
+    cmd = fsplit + ["index", "-i", data["fq1"]]
+    elapse, rss = run_cmd(cmd)
+    return {"command": "index", "elapse": round(elapse, 3), "peak_rss_kb": rss,
+            "reads_per_sec": round(reads / elapse, 1),
+            "mb_per_sec": round(nbytes / 1048576.0 / elapse, 2)}
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(
+        description="benchmark fsplit split and index on simulated fastq.")
+    parser.add_argument("-w", "--workdir", type=str, default="bench_work",
+                        help="work directory for simulated data, 'bench_work' by default", metavar="<str>")
+    parser.add_argument("-o", "--output", type=str, default="bench_result.json",
+                        help="output json file, 'bench_result.json' by default", metavar="<file>")
+    parser.add_argument("--fsplit", type=str, default="fsplit",
+                        help="fsplit command, 'fsplit' by default", metavar="<str>")
+    parser.add_argument("-n", "--reads", type=int, default=200000,
+                        help="reads number, 200000 by default", metavar="<int>")
+    parser.add_argument("-l", "--read-length", type=int, nargs="+", default=[100],
+                        help="read lengths, 100 by default", metavar="<int>")
+    parser.add_argument("-b", "--barcodes", type=int, nargs="+", default=[8, 96],
+                        help="barcode numbers, '8 96' by default", metavar="<int>")
+    parser.add_argument("-m", "--mismatch", type=int, nargs="+", default=[0, 1],
+                        help="mismatch values, '0 1' by default", metavar="<int>")
+    parser.add_argument("-t", "--threads", type=int, nargs="+", default=[1, 4],
+                        help="threads values, '1 4' by default", metavar="<int>")
+    parser.add_argument("--engine", nargs="+", default=["python"], choices=["python", "numpy"],
+                        help="barcode matching engines, 'python' by default")
+    parser.add_argument("--layout", nargs="+", default=["single", "paired"], choices=["single", "paired"],
+                        help="read layouts, 'single paired' by default")
+    parser.add_argument("--input-format", nargs="+", default=["gz"], choices=["gz", "plain"],
+                        help="input formats, 'gz' by default")
+    parser.add_argument("--output-gzip", action="store_true", default=False,
+                        help="also benchmark gzip output")
+    parser.add_argument("--qc", action="store_true", default=False,
+                        help="also benchmark --qc")
+    parser.add_argument("--mismatch-rate", type=float, default=0.1,
+                        help="fraction of reads with barcode errors, 0.1 by default", metavar="<float>")
+    parser.add_argument("--unknown-rate", type=float, default=0.05,
+                        help="fraction of reads with random barcodes, 0.05 by default", metavar="<float>")
+    parser.add_argument("--no-check", action="store_true", default=False,
+                        help="skip per-sample correctness check against ground truth")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArg()
+    fsplit = shlex.split(args.fsplit)
+    results = []
+    gz_outs = args.output_gzip and [False, True] or [False]
+    qcs = args.qc and [False, True] or [False]
+    for rl, nbc, layout, fmt in itertools.product(args.read_length, args.barcodes,
+                                                  args.layout, args.input_format):
+        paired = layout == "paired"
+        workdir = os.path.join(args.workdir, "%s_%s_l%d_b%d" %
+                               (layout, fmt, rl, nbc))
+        data = simulate(workdir, reads=args.reads, read_length=rl, barcodes=nbc,
+                        paired=paired, gz=fmt == "gz", mismatch_rate=args.mismatch_rate,
+                        unknown_rate=args.unknown_rate)
+        nbytes = input_bytes(data["fq1"]) + \
+            (paired and input_bytes(data["fq2"]) or 0)
+        params = {"layout": layout, "input_format": fmt, "read_length": rl,
+                  "barcodes": nbc, "reads": args.reads, "input_bytes": nbytes}
+        if fmt == "gz" and not paired:
+            res = bench_index(fsplit, data, args.reads, nbytes)
+            res.update(params)
+            results.append(res)
+            sys.stderr.write("%s\n" % json.dumps(res, sort_keys=True))
+        for mis, th, engine, gz_out, qc in itertools.product(args.mismatch, args.threads, args.engine,
+                                                             gz_outs, qcs):
+            res = bench_split(fsplit, data, workdir, mis, th, engine, gz_out, qc,
+                              paired, args.reads, nbytes, not args.no_check)
+            res.update(params)
+            results.append(res)
+            sys.stderr.write("%s\n" % json.dumps(res, sort_keys=True))
+    version = subprocess.check_output(fsplit + ["-v"]).decode().strip()
+    with open(args.output, "w") as fo:
+        json.dump({"fsplit_version": version, "platform": platform.platform(), "python": platform.python_version(),
+                   "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "results": results}, fo, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
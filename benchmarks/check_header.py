@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulate import make_barcodes, random_seq
+from fsplit.split import FastqSplitter, mmap_batches
+
+
+def write_fastq(path, reads, read_length, barcodes, seed=1):
+    rd = random.Random(seed)
+    samples = sorted(barcodes)
+    truth = Counter()
+    with open(path, "w") as fo:
+        for i in range(reads):
+            sn = rd.choice(samples)
+            truth[sn] += 1
+            seq = random_seq(rd, read_length)
+            fo.write("@r%d 1:N:0:%s\n%s\n+\n%s\n" %
+                     (i, barcodes[sn], seq, "I" * read_length))
+    return truth
+
+
+def check(reads, read_length, nbc):
+    tmpdir = tempfile.mkdtemp(prefix="fsplit_header_")
+    try:
+        rd = random.Random(1)
+        barcodes = dict(("S%d" % (i+1), bc)
+                        for i, bc in enumerate(make_barcodes(rd, nbc, 8)))
+        fq = os.path.join(tmpdir, "R1.fq")
+        truth = write_fastq(fq, reads, read_length, barcodes)
+        batches = mmap_batches(fq, threads=4, span=1 << 20)
+        if len(batches) < 2:
+            raise RuntimeError("%d reads fit in one batch, use more" % reads)
+        bc = dict((b.encode(), sn) for sn, b in barcodes.items())
+        got = Counter()
+        for batch in batches:
+            # a fresh splitter takes the tag width from its first batch,
+            # as every worker does
+            splitter = FastqSplitter(bc, source="header")
+            _, sms, _, _, _ = splitter.split(batch)
+            if splitter.header_miss:
+                raise RuntimeError("batch at byte %d: %d header tails reparsed, tag width %d" % (
+                    batch.span1[0], len(splitter.header_miss), splitter.tag_width))
+            got.update(sms)
+        if got != truth:
+            raise RuntimeError("sample counts differ: %s != %s" % (got, truth))
+        sys.stdout.write("header mode ok, %d batches, %d reads\n" %
+                         (len(batches), sum(got.values())))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(
+        description="check --barcode-source header on mmap batches starting past byte 0.")
+    parser.add_argument("-n", "--reads", type=int, default=20000,
+                        help="reads number, 20000 by default", metavar="<int>")
+    parser.add_argument("-l", "--read-length", type=int, default=100,
+                        help="read length, 100 by default", metavar="<int>")
+    parser.add_argument("-b", "--barcodes", type=int, default=8,
+                        help="barcode number, 8 by default", metavar="<int>")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArg()
+    check(args.reads, args.read_length, args.barcodes)
+
+
+if __name__ == "__main__":
+    main()
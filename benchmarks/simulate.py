@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import io
+import os
+import sys
+import gzip
+import random
+import argparse
+
+BASES = "ACGT"
+
+
+def hamming(a, b):
+    return sum(i != j for i, j in zip(a, b))
+
+
+def random_seq(rd, n):
+    return "".join(rd.choices(BASES, k=n))
+
+
+def make_barcodes(rd, num, length, min_dist=3):
+    bcs = []
+    tries = 0
+    while len(bcs) < num:
+        bc = random_seq(rd, length)
+        tries += 1
+        if tries > num * 1000:
+            min_dist, tries = max(min_dist - 1, 1), 0
+        if all(hamming(bc, b) >= min_dist for b in bcs):
+            bcs.append(bc)
+    return bcs
+
+
+def mutate(rd, seq, n):
+    seq = list(seq)
+    for p in rd.sample(range(len(seq)), min(n, len(seq))):
+        seq[p] = rd.choice([b for b in BASES + "N" if b != seq[p]])
+    return "".join(seq)
+
+
+def fastq_open(path, mode="wt"):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.GzipFile(path, mode.replace("t", "b"), compresslevel=1, mtime=0))
+    return open(path, mode)
+
+
+def simulate(outdir, reads=100000, read_length=100, barcodes=24, bc_length=8,
+             paired=False, gz=True, mismatch_rate=0.1, unknown_rate=0.05, seed=1):
+    rd = random.Random(seed)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    bc1 = make_barcodes(rd, barcodes, bc_length)
+    bc2 = make_barcodes(rd, barcodes, bc_length)
+    samples = ["S%d" % (i+1) for i in range(barcodes)]
+    bcfile = os.path.join(outdir, "barcode.info")
+    with open(bcfile, "w") as fo:
+        for sn, a, b in zip(samples, bc1, bc2):
+            fo.write("%s\t%s\t%s\n" % (sn, a, b) if paired else "%s\t%s\n" % (sn, a))
+    suffix = gz and ".fq.gz" or ".fq"
+    fq1 = os.path.join(outdir, "R1" + suffix)
+    fq2 = paired and os.path.join(outdir, "R2" + suffix) or None
+    truth = os.path.join(outdir, "truth.tsv")
+    f1 = fastq_open(fq1)
+    f2 = paired and fastq_open(fq2)
+    with open(truth, "w") as ft:
+        for n in range(reads):
+            i = rd.randrange(barcodes)
+            if rd.random() < unknown_rate:
+                a, b, origin = random_seq(rd, bc_length), random_seq(
+                    rd, bc_length), "Unknow"
+            else:
+                a, b, origin = bc1[i], bc2[i], samples[i]
+                if rd.random() < mismatch_rate:
+                    a = mutate(rd, a, rd.choice([1, 1, 1, 2]))
+                if paired and rd.random() < mismatch_rate:
+                    b = mutate(rd, b, 1)
+            name = "R%d:1:FCX:1:1101:%d:%d" % (n, n % 30000, n // 30000)
+            ins = random_seq(rd, max(read_length - bc_length, 1))
+            f1.write("@%s 1:N:0:%s\n%s\n+\n%s\n" %
+                     (name, a, a + ins, "F" * (len(ins) + bc_length)))
+            if paired:
+                ins2 = random_seq(rd, max(read_length - bc_length, 1))
+                f2.write("@%s 2:N:0:%s\n%s\n+\n%s\n" %
+                         (name, b, b + ins2, "F" * (len(ins2) + bc_length)))
+            ft.write("%s\t%s\t%s\t%s\n" % (name, origin, a, paired and b or ""))
+    f1.close()
+    if f2:
+        f2.close()
+    return {"fq1": fq1, "fq2": fq2, "barcode": bcfile, "truth": truth}
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(
+        description="simulate mixed barcoded fastq with ground truth for fsplit benchmarks.")
+    parser.add_argument("-o", "--outdir", type=str, required=True,
+                        help="output directory, required", metavar="<str>")
+    parser.add_argument("-n", "--reads", type=int, default=100000,
+                        help="reads number, 100000 by default", metavar="<int>")
+    parser.add_argument("-l", "--read-length", type=int, default=100,
+                        help="read length, 100 by default", metavar="<int>")
+    parser.add_argument("-b", "--barcodes", type=int, default=24,
+                        help="barcode number, 24 by default", metavar="<int>")
+    parser.add_argument("--bc-length", type=int, default=8,
+                        help="barcode length, 8 by default", metavar="<int>")
+    parser.add_argument("--paired", action="store_true", default=False,
+                        help="simulate paired fastq with dual barcodes")
+    parser.add_argument("--plain", action="store_true", default=False,
+                        help="write uncompressed fastq")
+    parser.add_argument("--mismatch-rate", type=float, default=0.1,
+                        help="fraction of reads with barcode errors, 0.1 by default", metavar="<float>")
+    parser.add_argument("--unknown-rate", type=float, default=0.05,
+                        help="fraction of reads with random barcodes, 0.05 by default", metavar="<float>")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed, 1 by default", metavar="<int>")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArg()
+    out = simulate(args.outdir, reads=args.reads, read_length=args.read_length,
+                   barcodes=args.barcodes, bc_length=args.bc_length, paired=args.paired,
+                   gz=not args.plain, mismatch_rate=args.mismatch_rate,
+                   unknown_rate=args.unknown_rate, seed=args.seed)
+    for k, v in sorted(out.items()):
+        sys.stdout.write("%s: %s\n" % (k, v))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import sys
+import gzip
+import zlib
+import struct
+import random
+import argparse
+
+from simulate import make_barcodes, mutate, random_seq
+
+BASE_CODE = {"A": 0, "C": 1, "G": 2, "T": 3}
+CBCL_BINS = [(0, 2), (1, 12), (2, 23), (3, 37)]
+
+
+def run_info(fcdir, reads, lanes, tiles, flowcell):
+    with open(os.path.join(fcdir, "RunInfo.xml"), "w") as fo:
+        fo.write('<?xml version="1.0"?>\n<RunInfo Version="2">\n')
+        fo.write('  <Run Id="SIM_%s" Number="1">\n' % flowcell)
+        fo.write('    <Flowcell>%s</Flowcell>\n    <Instrument>SIM</Instrument>\n' % flowcell)
+        fo.write('    <Reads>\n')
+        for n, (cycles, index) in enumerate(reads):
+            fo.write('      <Read Number="%d" NumCycles="%d" IsIndexedRead="%s" />\n' %
+                     (n + 1, cycles, index and "Y" or "N"))
+        fo.write('    </Reads>\n')
+        fo.write('    <FlowcellLayout LaneCount="%d" SurfaceCount="1" SwathCount="1" TileCount="%d">\n' %
+                 (lanes, len(tiles)))
+        fo.write('      <TileSet TileNamingConvention="FourDigit">\n        <Tiles>\n')
+        for lane in range(1, lanes + 1):
+            for t in tiles:
+                fo.write('          <Tile>%d_%d</Tile>\n' % (lane, t))
+        fo.write('        </Tiles>\n      </TileSet>\n    </FlowcellLayout>\n  </Run>\n</RunInfo>\n')
+
+
+def write_filter(path, pf):
+    with open(path, "wb") as fo:
+        fo.write(struct.pack("<III", 0, 3, len(pf)))
+        fo.write(bytes(bytearray(pf)))
+
+
+def write_locs(path, n, rd):
+    with open(path, "wb") as fo:
+        fo.write(struct.pack("<IfI", 1, 1.0, n))
+        for _ in range(n):
+            fo.write(struct.pack("<ff", rd.uniform(0, 2000), rd.uniform(0, 2000)))
+
+
+def bcl_byte(base, q):
+    if base == "N":
+        return 0
+    return q << 2 | BASE_CODE[base]
+
+
+def cbcl_nibble(base, q):
+    if base == "N":
+        return 0
+    return (1 + min(q // 14, 2)) << 2 | BASE_CODE[base]
+
+
+def write_cbcl(path, tiles, calls, excluded):
+    blocks = []
+    for t, nibs in zip(tiles, calls):
+        n = len(nibs)
+        if n % 2:
+            nibs = nibs + [0]
+        raw = bytes(bytearray(nibs[i] | nibs[i+1] << 4 for i in range(0, len(nibs), 2)))
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        blocks.append((t, n, len(raw), c.compress(raw) + c.flush()))
+    head = struct.pack("<BBI", 2, 2, len(CBCL_BINS))
+    for b, q in CBCL_BINS:
+        head += struct.pack("<II", b, q)
+    head += struct.pack("<I", len(blocks))
+    for t, n, usize, data in blocks:
+        head += struct.pack("<IIII", t, n, usize, len(data))
+    head += struct.pack("<B", excluded and 1 or 0)
+    with open(path, "wb") as fo:
+        fo.write(struct.pack("<HI", 1, len(head) + 6))
+        fo.write(head)
+        for block in blocks:
+            fo.write(block[3])
+
+
+def simulate_flowcell(fcdir, clusters=2000, lanes=1, tiles=(1101, 1102), read_length=50, paired=True,
+                      samples=8, bc_length=8, fmt="bcl", gz=True, pf_rate=0.9, mismatch_rate=0.1,
+                      unknown_rate=0.05, nocall_rate=0.002, excluded=False, seed=1):
+    rd = random.Random(seed)
+    tiles = list(tiles)
+    basecalls = os.path.join(fcdir, "Data", "Intensities", "BaseCalls")
+    if not os.path.isdir(basecalls):
+        os.makedirs(basecalls)
+    reads = [(read_length, False), (bc_length, True), (bc_length, True)]
+    if paired:
+        reads.append((read_length, False))
+    run_info(fcdir, reads, lanes, tiles, "SIMFC")
+    i7 = make_barcodes(rd, samples, bc_length)
+    i5 = make_barcodes(rd, samples, bc_length)
+    names = ["S%d" % (i + 1) for i in range(samples)]
+    with open(os.path.join(fcdir, "barcode.info"), "w") as fo:
+        for sn, a, b in zip(names, i7, i5):
+            fo.write("%s\t%s\t%s\n" % (sn, a, b))
+    ncycles = sum(r[0] for r in reads)
+    truth = open(os.path.join(fcdir, "truth.tsv"), "w")
+    for lane in range(1, lanes + 1):
+        ldir = os.path.join(basecalls, "L%03d" % lane)
+        for c in range(ncycles):
+            os.makedirs(os.path.join(ldir, "C%d.1" % (c + 1)), exist_ok=True)
+        tile_calls = {}
+        for tile in tiles:
+            pf = [rd.random() < pf_rate for _ in range(clusters)]
+            write_filter(os.path.join(ldir, "s_%d_%d.filter" % (lane, tile)), pf)
+            ldir_locs = os.path.join(fcdir, "Data", "Intensities", "L%03d" % lane)
+            os.makedirs(ldir_locs, exist_ok=True)
+            write_locs(os.path.join(ldir_locs, "s_%d_%d.locs" % (lane, tile)), clusters, rd)
+            seqs = []
+            for n in range(clusters):
+                i = rd.randrange(samples)
+                origin = names[i]
+                a, b = i7[i], i5[i]
+                if rd.random() < unknown_rate:
+                    a, origin = random_seq(rd, bc_length), "Unknow"
+                elif rd.random() < mismatch_rate:
+                    a = mutate(rd, a, 1)
+                seq = random_seq(rd, read_length) + a + b
+                if paired:
+                    seq += random_seq(rd, read_length)
+                seq = "".join(rd.random() < nocall_rate and "N" or s for s in seq)
+                quals = [rd.randint(2, 41) for _ in seq]
+                seqs.append((seq, quals))
+                if pf[n]:
+                    truth.write("%d\t%d\t%d\t%s\t%s\n" % (lane, tile, n, origin, seq))
+            tile_calls[tile] = (pf, seqs)
+        for c in range(ncycles):
+            cdir = os.path.join(ldir, "C%d.1" % (c + 1))
+            if fmt == "cbcl":
+                # one cbcl per surface, named by the first digit of its tiles
+                surfaces = {}
+                for tile in tiles:
+                    pf, seqs = tile_calls[tile]
+                    surfaces.setdefault(tile // 1000, []).append(
+                        (tile, [cbcl_nibble(s[c], q[c]) for (s, q), p in zip(seqs, pf)
+                                if p or not excluded]))
+                for surface, calls in sorted(surfaces.items()):
+                    write_cbcl(os.path.join(cdir, "L%03d_%d.cbcl" % (lane, surface)),
+                               [t for t, _ in calls], [n for _, n in calls], excluded)
+                continue
+            for tile in tiles:
+                pf, seqs = tile_calls[tile]
+                data = struct.pack("<I", len(seqs)) + \
+                    bytes(bytearray(bcl_byte(s[c], q[c]) for s, q in seqs))
+                path = os.path.join(cdir, "s_%d_%d.bcl" % (lane, tile))
+                if gz:
+                    with gzip.GzipFile(path + ".gz", "wb", mtime=0) as fo:
+                        fo.write(data)
+                else:
+                    with open(path, "wb") as fo:
+                        fo.write(data)
+    truth.close()
+    return {"fcdir": fcdir, "barcode": os.path.join(fcdir, "barcode.info"),
+            "truth": os.path.join(fcdir, "truth.tsv")}
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(
+        description="simulate a small illumina flowcell directory (bcl or cbcl) with ground truth for fsplit bcl2fq.")
+    parser.add_argument("-o", "--outdir", type=str, required=True,
+                        help="output flowcell directory, required", metavar="<str>")
+    parser.add_argument("-n", "--clusters", type=int, default=2000,
+                        help="clusters per tile, 2000 by default", metavar="<int>")
+    parser.add_argument("--lanes", type=int, default=1,
+                        help="lane number, 1 by default", metavar="<int>")
+    parser.add_argument("--tiles", type=int, nargs="+", default=[1101, 1102],
+                        help="tile numbers, '1101 1102' by default", metavar="<int>")
+    parser.add_argument("-l", "--read-length", type=int, default=50,
+                        help="read length, 50 by default", metavar="<int>")
+    parser.add_argument("-b", "--samples", type=int, default=8,
+                        help="sample number, 8 by default", metavar="<int>")
+    parser.add_argument("--single", action="store_true", default=False,
+                        help="single end reads")
+    parser.add_argument("--format", choices=["bcl", "cbcl"], default="bcl",
+                        help="basecall file format, 'bcl' by default")
+    parser.add_argument("--plain", action="store_true", default=False,
+                        help="write uncompressed .bcl instead of .bcl.gz")
+    parser.add_argument("--excluded", action="store_true", default=False,
+                        help="exclude non-PF clusters from cbcl files")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed, 1 by default", metavar="<int>")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArg()
+    out = simulate_flowcell(args.outdir, clusters=args.clusters, lanes=args.lanes, tiles=args.tiles,
+                            read_length=args.read_length, paired=not args.single, samples=args.samples,
+                            fmt=args.format, gz=not args.plain, excluded=args.excluded, seed=args.seed)
+    for k, v in sorted(out.items()):
+        sys.stdout.write("%s: %s\n" % (k, v))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import argparse
+import xml.etree.ElementTree as ET
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(
+        description="stand-in bcl2fastq for testing 'fsplit bcl2fq --bcl2fq', writes one read per sample and tile, "
+                    "and Undetermined reads with two index mismatches to each sample. "
+                    "If STUB_BCL2FASTQ_FAIL_DIR is set, every distinct --tiles value fails once before succeeding.")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("-R", "--runfolder-dir", required=True)
+    parser.add_argument("-i", "--input-dir")
+    parser.add_argument("-p", "--processing-threads", type=int, default=1)
+    parser.add_argument("-r", "--loading-threads", type=int, default=4)
+    parser.add_argument("-w", "--writing-threads", type=int, default=4)
+    parser.add_argument("--sample-sheet", required=True)
+    parser.add_argument("--barcode-mismatches", type=int, default=1)
+    parser.add_argument("--tiles")
+    parser.add_argument("--no-lane-splitting", action="store_true")
+    return parser.parse_args()
+
+
+def load_tiles(runfolder, pattern):
+    run = ET.parse(os.path.join(runfolder, "RunInfo.xml")).getroot()
+    tiles = ["s_" + t.text for t in run.iter("Tile")]
+    if pattern:
+        pats = [re.compile(p) for p in pattern.split(",")]
+        tiles = [t for t in tiles if any(p.match(t) for p in pats)]
+    return tiles
+
+
+def shift(index):
+    # two mismatches, beyond the default --barcode-mismatches
+    return "".join("ACGT"["ACGT".index(b) - 1] for b in index[:2]) + index[2:]
+
+
+def load_samples(path):
+    samples = []
+    with open(path) as fi:
+        data = False
+        for line in fi:
+            line = line.strip()
+            if line == "[Data]":
+                data = True
+            elif data and line and not line.startswith("Sample_ID"):
+                samples.append(line.split(","))
+    return samples
+
+
+def main():
+    args = parseArg()
+    fail = os.environ.get("STUB_BCL2FASTQ_FAIL_DIR")
+    if fail:
+        marker = os.path.join(fail, hashlib.md5(
+            str(args.tiles).encode()).hexdigest())
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            sys.stderr.write("stub failure for tiles %s\n" % args.tiles)
+            sys.exit(1)
+    tiles = load_tiles(args.runfolder_dir, args.tiles)
+    samples = load_samples(args.sample_sheet)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    lanes = {}
+    for t in tiles:
+        lanes.setdefault(int(t.split("_")[1]), []).append(t)
+    for r in (1, 2):
+        path = os.path.join(args.output_dir, "Undetermined_S0_R%d_001.fastq.gz" % r)
+        with gzip.open(path, "wb") as fo:
+            for t in tiles:
+                for line in samples:
+                    index = "+".join(shift(i) for i in line[1:])
+                    fo.write(("@%s:%s %d:N:0:%s\nACGT\n+\nFFFF\n" % (t, line[0], r, index)).encode())
+                fo.write(("@%s:Undetermined %d:N:0:%s\nACGT\n+\nFFFF\n" % (
+                    t, r, "+".join("N" * len(i) for i in samples[0][1:]))).encode())
+        for k, line in enumerate(samples):
+            path = os.path.join(args.output_dir, "%s_S%d_R%d_001.fastq.gz" % (line[0], k + 1, r))
+            with gzip.open(path, "wb") as fo:
+                for t in tiles:
+                    fo.write(("@%s:%s %d:N:0:%s\nACGT\n+\nFFFF\n" % (
+                        t, line[0], r, "+".join(line[1:]))).encode())
+    res = {"Flowcell": "STUB", "RunNumber": 1, "RunId": "STUB",
+           "ReadInfosForLanes": [{"LaneNumber": lane, "ReadInfos": [{"Number": 1, "NumCycles": 4, "IsIndexedRead": False}]}
+                                 for lane in sorted(lanes)],
+           "ConversionResults": [], "UnknownBarcodes": []}
+    for lane, ts in sorted(lanes.items()):
+        n, u = len(ts), len(ts) * (len(samples) + 1)
+        res["ConversionResults"].append({
+            "LaneNumber": lane, "TotalClustersRaw": n * len(samples) + u, "TotalClustersPF": n * len(samples) + u,
+            "Yield": (n * len(samples) + u) * 4,
+            "DemuxResults": [{"SampleId": line[0], "SampleName": line[0], "NumberReads": n, "Yield": n * 4,
+                              "IndexMetrics": [{"IndexSequence": "+".join(line[1:]), "MismatchCounts": {"0": n}}],
+                              "ReadMetrics": [{"ReadNumber": 1, "Yield": n * 4, "YieldQ30": n * 4}]}
+                             for line in samples],
+            "Undetermined": {"NumberReads": u, "Yield": u * 4,
+                             "ReadMetrics": [{"ReadNumber": 1, "Yield": u * 4, "YieldQ30": u * 4}]}})
+        res["UnknownBarcodes"].append({"Lane": lane, "Barcodes": {"NNNNNNNN": n}})
+    sdir = os.path.join(args.output_dir, "Stats")
+    if not os.path.isdir(sdir):
+        os.makedirs(sdir)
+    with open(os.path.join(sdir, "Stats.json"), "w") as fo:
+        json.dump(res, fo, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+import mmap
+import hashlib
+
+from itertools import combinations, product
+
+from .utils import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SUBSTITUTE_BASES = b"ACGTN"
+
+WHITELIST_MAGIC = b"FWLST"
+WHITELIST_VERSION = 1
+WHITELIST_HEAD = struct.Struct("<5sH20sIIQQ")
+WHITELIST_AMBIGUOUS = (1 << 30) - 1
+
+
+class BarcodeIndex(object):
+
+    def __init__(self, barcodes, mis=0, bases=SUBSTITUTE_BASES):
+        self.barcodes = list(dict.fromkeys(barcodes))
+        self.mis = mis
+        self.bases = bytearray(bases)
+        self.table = {}
+        self.collisions = {}
+        self.build()
+
+    def neighbors(self, bc):
+        bc = bytearray(bc)
+        yield bytes(bc), 0
+        for d in range(1, min(self.mis, len(bc)) + 1):
+            for pos in combinations(range(len(bc)), d):
+                subs = [[b for b in self.bases if b != bc[p]] for p in pos]
+                for bs in product(*subs):
+                    nb = bytearray(bc)
+                    for p, b in zip(pos, bs):
+                        nb[p] = b
+                    yield bytes(nb), d
+
+    def build(self):
+        for bc in self.barcodes:
+            tab = self.table.setdefault(len(bc), {})
+            for nb, d in self.neighbors(bc):
+                hit = tab.get(nb)
+                if hit is None:
+                    if nb in self.collisions:
+                        if self.collisions[nb][0] <= d:
+                            continue
+                        del self.collisions[nb]
+                    tab[nb] = (bc, d)
+                elif d < hit[1]:
+                    tab[nb] = (bc, d)
+                elif d == hit[1] and hit[0] != bc:
+                    self.collisions[nb] = (d, hit[0], bc)
+                    del tab[nb]
+        self.lengths = sorted(self.table, reverse=True)
+        self.width = self.lengths and self.lengths[0] or 0
+        if len(self.lengths) > 1:
+            self._resolve_lengths()
+        if self.collisions:
+            self.logs.warning("%d ambiguous barcode neighbors within %d mismatch, reads matching them are treated as unknown",
+                              len(self.collisions), self.mis)
+            for nb, (d, b1, b2) in sorted(self.collisions.items()):
+                self.logs.debug("barcode collision: %s -> %s, %s (mismatch %d)",
+                                nb.decode(), b1.decode(), b2.decode(), d)
+
+    def _resolve_lengths(self):
+        # a read prefix can hit barcodes of different length, keep the
+        # closest one for every longer key and drop ties as collisions
+        for i, L in enumerate(self.lengths):
+            tab = self.table[L]
+            for nb in list(tab):
+                bc, d = tab[nb]
+                for S in self.lengths[i+1:]:
+                    hit = self.table[S].get(nb[:S])
+                    if hit is None or hit[1] > d:
+                        continue
+                    if hit[1] == d:
+                        self.collisions[nb] = (d, bc, hit[0])
+                        tab[nb] = (None, d)
+                    else:
+                        del tab[nb]
+                    break
+
+    def search(self, seq):
+        for L in self.lengths:
+            hit = self.table[L].get(seq[:L])
+            if hit is not None:
+                return hit
+        return None
+
+    def match(self, seq):
+        hit = self.search(seq)
+        return hit and hit[0] or None
+
+    def search_many(self, seqs):
+        return [self.search(s) for s in seqs]
+
+    def match_many(self, seqs):
+        return [self.match(s) for s in seqs]
+
+    def search_block(self, block):
+        return self.search_many(block.seqs(self.width))
+
+    def match_block(self, block):
+        return self.match_many(block.seqs(self.width))
+
+    def search_window(self, seq, start=0):
+        best, at = None, 0
+        for o in range(len(seq) - (self.lengths and self.lengths[-1] or 0) + 1):
+            hit = self.search(seq[o:o+self.width])
+            if hit is not None and hit[0] is not None and (best is None or hit[1] < best[1]):
+                best, at = hit, o
+                if not hit[1]:
+                    break
+        return best and (best[0], start + at + len(best[0])) or None
+
+    def match_window(self, block, start, end):
+        return [self.search_window(s, start) for s in block.regions(start, end)]
+
+    def __len__(self):
+        return sum(len(t) for t in self.table.values())
+
+    @property
+    def logs(self):
+        return logging.getLogger()
+
+
+class NumpyBarcodeIndex(object):
+
+    chunk_cells = 1 << 22
+
+    def __init__(self, barcodes, mis=0, bases=SUBSTITUTE_BASES):
+        if np is None:
+            raise ImportError("numpy is required for numpy barcode matching")
+        self.barcodes = list(dict.fromkeys(barcodes))
+        self.mis = mis
+        self.bases = np.zeros(256, dtype=bool)
+        self.bases[np.frombuffer(bases, dtype=np.uint8)] = True
+        self.lengths = sorted(set(len(b) for b in self.barcodes), reverse=True)
+        self.width = self.lengths and self.lengths[0] or 0
+        self.groups = []
+        for L in self.lengths:
+            ids = [n for n, b in enumerate(self.barcodes) if len(b) == L]
+            mat = np.frombuffer(b"".join(self.barcodes[i] for i in ids),
+                                dtype=np.uint8).reshape(len(ids), L)
+            self.groups.append((L, np.array(ids), mat))
+        self.objects = np.empty(len(self.barcodes) + 1, dtype=object)
+        self.objects[:-1] = self.barcodes
+
+    def prefixes(self, seqs):
+        w = self.width
+        buf = b"".join(s[:w].ljust(w, b"\0") for s in seqs)
+        return np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), w)
+
+    def _group_best(self, pre, ids, mat):
+        n, L = len(pre), mat.shape[0]
+        best = np.full(n, -1, dtype=np.int64)
+        dist = np.zeros(n, dtype=np.int64)
+        step = max(1, self.chunk_cells // max(L, 1))
+        for s in range(0, n, step):
+            p = pre[s:s+step]
+            d = np.zeros((len(p), L), dtype=np.int16)
+            bad = np.zeros((len(p), L), dtype=bool)
+            for j in range(mat.shape[1]):
+                mism = p[:, j, None] != mat[None, :, j]
+                d += mism
+                bad |= mism & ~self.bases[p[:, j]][:, None]
+            d[bad] = self.mis + 1
+            arg = d.argmin(axis=1)
+            dmin = d[np.arange(len(p)), arg]
+            uniq = (d == dmin[:, None]).sum(axis=1) == 1
+            ok = (dmin <= self.mis) & uniq
+            best[s:s+step] = np.where(ok, ids[arg], -1)
+            dist[s:s+step] = dmin
+        return best, dist
+
+    def _best(self, seqs):
+        if not len(seqs):
+            return self._best_matrix(np.zeros((0, self.width), dtype=np.uint8))
+        return self._best_matrix(self.prefixes(seqs))
+
+    def _best_matrix(self, pre):
+        n = len(pre)
+        if not n or not self.groups:
+            return np.full(n, -1, dtype=np.int64), np.zeros(n, dtype=np.int64)
+        hits = [self._group_best(pre[:, :L], ids, mat)
+                for L, ids, mat in self.groups]
+        if len(hits) == 1:
+            return hits[0]
+        # same precedence as BarcodeIndex: longer barcodes first, unless a
+        # shorter one is closer (dropped) or equally close (ambiguous)
+        best = np.full(n, -1, dtype=np.int64)
+        dist = np.zeros(n, dtype=np.int64)
+        todo = np.ones(n, dtype=bool)
+        for i, (bl, dl) in enumerate(hits):
+            keep = todo & (bl >= 0)
+            amb = np.zeros(n, dtype=bool)
+            undecided = keep.copy()
+            for bs, ds in hits[i+1:]:
+                hs = undecided & (bs >= 0) & (ds <= dl)
+                amb |= hs & (ds == dl)
+                keep &= ~hs
+                undecided &= ~hs
+            best[keep] = bl[keep]
+            dist[keep] = dl[keep]
+            best[amb] = len(self.barcodes)
+            dist[amb] = dl[amb]
+            todo &= ~(keep | amb)
+        return best, dist
+
+    def _hits(self, best, dist):
+        objs = self.objects
+        return [b >= 0 and (objs[b], d) or None
+                for b, d in zip(best.tolist(), dist.tolist())]
+
+    def search_many(self, seqs):
+        return self._hits(*self._best(seqs))
+
+    def match_many(self, seqs):
+        best = self._best(seqs)[0]
+        return self.objects[best].tolist()
+
+    def search_block(self, block):
+        return self._hits(*self._best_matrix(block.prefixes(self.width)))
+
+    def match_block(self, block):
+        best = self._best_matrix(block.prefixes(self.width))[0]
+        return self.objects[best].tolist()
+
+    def match_window(self, block, start, end):
+        n, nbc = len(block), len(self.barcodes)
+        best = np.full(n, -1, dtype=np.int64)
+        dist = np.full(n, self.mis + 1, dtype=np.int64)
+        at = np.zeros(n, dtype=np.int64)
+        for o in range(start, end - (self.lengths and self.lengths[-1] or 0) + 1):
+            todo = np.flatnonzero(dist > 0)
+            if not len(todo):
+                break
+            b, d = self._best_matrix(block.prefixes(self.width, o, end, todo))
+            better = (b >= 0) & (b < nbc) & (d < dist[todo])
+            rows = todo[better]
+            best[rows], dist[rows], at[rows] = b[better], d[better], o
+        lens = np.array([len(bc) for bc in self.barcodes] + [0], dtype=np.int64)
+        ends = (at + lens[best]).tolist()
+        objs = self.objects
+        return [b >= 0 and (objs[b], e) or None for b, e in zip(best.tolist(), ends)]
+
+    def match_matrix(self, pre):
+        best = self._best_matrix(pre)[0]
+        best[best >= len(self.barcodes)] = -1
+        return best
+
+    def search(self, seq):
+        return self.search_many([seq])[0]
+
+    def match(self, seq):
+        return self.match_many([seq])[0]
+
+
+class WhitelistIndex(NumpyBarcodeIndex):
+
+    def __init__(self, barcodes, mis=0, cache=None):
+        if np is None:
+            raise ImportError("numpy is required for whitelist barcode matching")
+        self.barcodes = list(dict.fromkeys(barcodes))
+        self.mis = mis
+        self.lengths = sorted(set(len(b) for b in self.barcodes), reverse=True)
+        if len(self.lengths) > 1:
+            raise IOError("whitelist barcodes must have the same length")
+        self.width = self.lengths and self.lengths[0] or 0
+        if self.width > 32:
+            raise IOError("whitelist barcodes longer than 32bp not supported")
+        if mis > 3:
+            raise IOError("whitelist barcode matching allows at most 3 mismatches")
+        self.objects = np.empty(len(self.barcodes) + 1, dtype=object)
+        self.objects[:-1] = self.barcodes
+        self.code = np.full(256, 5, dtype=np.uint8)
+        for i, b in enumerate(b"ACGT"):
+            self.code[b] = i
+        self.code[ord("N")] = 4
+        self.shift = (2 * np.arange(self.width - 1, -1, -1)).astype(np.uint64)
+        self.digest = hashlib.sha1(b"\n".join(self.barcodes) +
+                                   b"\t%d" % mis).digest()
+        self.path = cache and "%s.%s.fwl" % (
+            cache, hashlib.sha1(self.digest).hexdigest()[:16]) or None
+        self.mm = None
+        if not (self.path and self.load()):
+            self.build()
+            if self.path and self.save():
+                self.load()
+
+    def pack(self, codes):
+        return (codes.astype(np.uint64) << self.shift).sum(axis=1, dtype=np.uint64)
+
+    def build(self):
+        codes = self.code[np.frombuffer(b"".join(self.barcodes), dtype=np.uint8)].reshape(
+            len(self.barcodes), self.width)
+        if (codes > 3).any():
+            raise IOError("whitelist barcodes must only contain A, C, G, T")
+        ids = np.arange(len(self.barcodes), dtype=np.uint32) << 2
+        self.bckeys = self.pack(codes)
+        keys, vals = [self.bckeys], [ids]
+        for d in range(1, min(self.mis, self.width) + 1):
+            for pos in combinations(range(self.width), d):
+                for deltas in product((1, 2, 3), repeat=d):
+                    k = self.bckeys.copy()
+                    for p, dl in zip(pos, deltas):
+                        c = codes[:, p]
+                        k ^= (c ^ ((c + dl) & 3)).astype(np.uint64) << self.shift[p]
+                    keys.append(k)
+                    vals.append(ids | d)
+        keys, vals = np.concatenate(keys), np.concatenate(vals)
+        order = np.lexsort((vals & 3, keys))
+        keys, vals = keys[order], vals[order]
+        del order
+        head = np.ones(len(keys), dtype=bool)
+        head[1:] = keys[1:] != keys[:-1]
+        amb = np.zeros(len(keys), dtype=bool)
+        amb[:-1] = ~head[1:] & ((vals[1:] & 3) == (vals[:-1] & 3))
+        vals[amb] = (WHITELIST_AMBIGUOUS << 2) | (vals[amb] & 3)
+        self.keys, self.vals = keys[head], vals[head]
+        namb = int(amb[head].sum())
+        self.logs.info("build whitelist index with %d barcodes, %d keys",
+                       len(self.barcodes), len(self.keys))
+        if namb:
+            self.logs.warning("%d ambiguous barcode neighbors within %d mismatch, reads matching them are treated as unknown",
+                              namb, self.mis)
+
+    def save(self):
+        tmp = "%s.tmp%d" % (self.path, os.getpid())
+        try:
+            with open(tmp, "wb") as fo:
+                fo.write(WHITELIST_HEAD.pack(WHITELIST_MAGIC, WHITELIST_VERSION, self.digest,
+                                             self.width, self.mis, len(self.bckeys), len(self.keys)))
+                fo.write(b"\0" * (-WHITELIST_HEAD.size % 8))
+                fo.write(self.bckeys.astype("<u8").tobytes())
+                fo.write(self.keys.astype("<u8").tobytes())
+                fo.write(self.vals.astype("<u4").tobytes())
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self.logs.warning("can not cache whitelist index: %s", e)
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, "rb") as fi:
+            mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, digest, width, mis, nbc, nkeys = WHITELIST_HEAD.unpack_from(
+                mm)
+        except struct.error:
+            magic = None
+        if magic != WHITELIST_MAGIC or version != WHITELIST_VERSION or digest != self.digest \
+                or len(mm) < WHITELIST_HEAD.size + (-WHITELIST_HEAD.size % 8) + nbc * 8 + nkeys * 12:
+            self.logs.warning("ignore invalid whitelist index %s", self.path)
+            mm.close()
+            return False
+        offset = WHITELIST_HEAD.size + (-WHITELIST_HEAD.size % 8)
+        self.bckeys = np.frombuffer(mm, dtype="<u8", count=nbc, offset=offset)
+        offset += nbc * 8
+        self.keys = np.frombuffer(mm, dtype="<u8", count=nkeys, offset=offset)
+        offset += nkeys * 8
+        self.vals = np.frombuffer(mm, dtype="<u4", count=nkeys, offset=offset)
+        self.mm = mm
+        self.logs.info("load whitelist index %s", self.path)
+        return True
+
+    def lookup(self, q):
+        if not len(self.keys):
+            return np.full(len(q), -1, dtype=np.int64)
+        # sorted queries walk the key array in order, far fewer cache misses
+        order = np.argsort(q, kind="stable")
+        idx = np.empty(len(q), dtype=np.int64)
+        idx[order] = np.searchsorted(self.keys, q[order])
+        idx = np.minimum(idx, len(self.keys) - 1)
+        return np.where(self.keys[idx] == q, self.vals[idx].astype(np.int64), -1)
+
+    def _best_matrix(self, pre):
+        n = len(pre)
+        best = np.full(n, -1, dtype=np.int64)
+        dist = np.zeros(n, dtype=np.int64)
+        if not n or not self.width:
+            return best, dist
+        c = self.code[pre[:, :self.width]]
+        nN = (c == 4).sum(axis=1)
+        valid = ~(c > 4).any(axis=1)
+        keys = self.pack(np.where(c == 4, 0, c))
+        rows = np.flatnonzero(valid & (nN == 0))
+        v = self.lookup(keys[rows])
+        hit = v >= 0
+        rows, v = rows[hit], v[hit]
+        best[rows] = np.where(v >> 2 == WHITELIST_AMBIGUOUS,
+                              len(self.barcodes), v >> 2)
+        dist[rows] = v & 3
+        for k in range(1, min(self.mis, self.width) + 1):
+            rows = np.flatnonzero(valid & (nN == k))
+            if len(rows):
+                best[rows], dist[rows] = self._best_n(keys[rows], c[rows], k)
+        return best, dist
+
+    def _best_n(self, keys, c, k):
+        # a read base N mismatches every barcode, try A/C/G/T at each N and
+        # only count barcodes agreeing with the substituted bases
+        n = len(keys)
+        shift = self.shift[np.nonzero(c == 4)[1].reshape(n, k)][:, None, :]
+        reps = np.array(list(product(range(4), repeat=k)),
+                        dtype=np.uint64)[None, :, :]
+        q = keys[:, None] | (reps << shift).sum(axis=2, dtype=np.uint64)
+        v = self.lookup(q.ravel()).reshape(q.shape)
+        b, d = v >> 2, (v & 3) + k
+        amb = b == WHITELIST_AMBIGUOUS
+        bk = self.bckeys[np.where((v < 0) | amb, 0, b)]
+        agree = ((bk[:, :, None] >> shift) & 3 == reps).all(axis=2)
+        ok = (v >= 0) & (d <= self.mis) & (agree | amb)
+        d = np.where(ok, d, self.mis + 1)
+        dmin = d.min(axis=1)
+        top = ok & (d == dmin[:, None])
+        arg = top.argmax(axis=1)
+        hit = b[np.arange(n), arg]
+        res = np.where(top.sum(axis=1) > 1, len(self.barcodes),
+                       np.where(hit == WHITELIST_AMBIGUOUS, len(self.barcodes), hit))
+        return np.where(top.any(axis=1), res, -1), np.where(top.any(axis=1), dmin, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.pop("mm", None) is not None:
+            for k in ("bckeys", "keys", "vals"):
+                state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mm = None
+        if not hasattr(self, "keys") and not self.load():
+            raise IOError("whitelist index %s not available" % self.path)
+
+    @property
+    def logs(self):
+        return logging.getLogger()
+
+
+def barcode_index(barcodes, mis=0, engine="python", cache=None):
+    if engine == "whitelist":
+        return WhitelistIndex(barcodes, mis, cache)
+    if engine == "numpy":
+        return NumpyBarcodeIndex(barcodes, mis)
+    return BarcodeIndex(barcodes, mis)
@@ -1,9 +1,12 @@
-from .utils import *
+import re
+import xml.etree.ElementTree as ET
+
+from .split import *
 
 
 class BCL(object):
 
-    def __init__(self, fcdir, outdir, bcfile, cpu=60, bcl2fastq="", mis=1, rc_i7=False, rc_i5=False, mode="auto", logfile=None, **kw):
+    def __init__(self, fcdir, outdir, bcfile, cpu=60, bcl2fastq="", mis=1, rc_i7=False, rc_i5=False, mode="auto", logfile=None, jobs=1, retries=2, **kw):
         self.fcdir = fcdir
         self.outdir = outdir
         self.bcfile = bcfile
@@ -16,8 +19,11 @@ class BCL(object):
         self.logfile = logfile
         self.bcl2fastq = bcl2fastq or which("bcl2fastq")
         self.samplesheet = os.path.join(self.outdir, "sample-sheet.csv")
+        self.jobs = max(int(jobs), 1)
+        self.retries = max(int(retries), 0)
+        self.partdir = os.path.join(self.outdir, "partitions")
 
-    def create_samplesheet(self):
+    def load_samples(self):
         idx = []
         ignore_index2 = None
         with open(self.bcfile) as fi:
@@ -53,6 +59,15 @@ class BCL(object):
         idx = [i[:self.index+1] for i in idx[:]]
         if len(sum(idx, [])) != len(idx) * (self.index+1):
             raise IOError("illegal barcode input file")
+        for line in idx:
+            if self.rc_i7:
+                line[1] = rc_seq(line[1])
+            if self.index == 2 and self.rc_i5:
+                line[2] = rc_seq(line[2])
+        return idx
+
+    def create_samplesheet(self):
+        idx = self.load_samples()
         if not os.path.isdir(self.outdir):
             os.makedirs(self.outdir)
         with open(self.samplesheet, "w") as fo:
@@ -61,21 +76,103 @@ class BCL(object):
             else:
                 fo.write("[Data]\nSample_ID,index,index2\n")
             for line in idx:
-                if self.rc_i7:
-                    line[1] = rc_seq(line[1])
-                if self.index == 2 and self.rc_i5:
-                    line[2] = rc_seq(line[2])
                 fo.write(",".join(line) + "\n")
 
-    def make_bcl_cmd(self):
-        cmd = [self.bcl2fastq, "-o", self.outdir, "-R", self.fcdir,
+    def make_bcl_cmd(self, outdir=None, tiles=None, nproc=None):
+        cmd = [self.bcl2fastq, "-o", outdir or self.outdir, "-R", self.fcdir,
                "-i", os.path.join(self.fcdir, "Data/Intensities/BaseCalls"),
                "--no-lane-splitting",
                "--barcode-mismatches", self.mis,
-               "-p", self.nproc,
+               "-p", nproc or self.nproc,
                "--sample-sheet", self.samplesheet]
+        if tiles:
+            cmd.extend(["-r", "1", "-w", "1", "--tiles", tiles])
         return cmd
 
+    def partitions(self):
+        info = RunInfo(self.fcdir)
+        lanes = OrderedDict((lane, []) for lane in range(1, info.lanes + 1))
+        for t in info.tiles:
+            lane, tile = t.split("_", 1)
+            lanes.setdefault(int(lane), []).append(tile)
+        chunks = int(math.ceil(self.jobs / float(len(lanes))))
+        parts = []
+        for lane, tiles in lanes.items():
+            if not tiles:
+                parts.append("s_%d_" % lane)
+                continue
+            k = min(chunks, len(tiles))
+            for i in range(k):
+                parts.append(",".join("s_%d_%s" % (lane, t) for t in
+                                      tiles[i*len(tiles)//k:(i+1)*len(tiles)//k]))
+        return parts
+
+    def run_partition(self, part):
+        n, tiles, nproc = part
+        outdir = os.path.join(self.partdir, "p%03d" % n)
+        cmd = self.make_bcl_cmd(outdir, tiles, nproc)
+        for attempt in range(self.retries + 1):
+            if os.path.isdir(outdir):
+                shutil.rmtree(outdir)
+            os.makedirs(outdir)
+            self.logs.debug(cmd)
+            logfile = os.path.join(outdir, "bcl2fastq.log")
+            with open(logfile, "w") as fo:
+                code = subprocess.call(cmd, stdout=fo, stderr=fo)
+            if not code:
+                return outdir
+            self.logs.warning("bcl2fastq partition %d (%s) exit with code %d, attempt %d/%d",
+                              n, tiles, code, attempt + 1, self.retries + 1)
+        with open(logfile) as fi:
+            tail = "".join(deque(fi, 10))
+        raise IOError("bcl2fastq partition %d (%s) failed after %d attempts, see %s:\n%s" % (
+            n, tiles, self.retries + 1, logfile, tail))
+
+    def run_partitions(self):
+        parts = self.partitions()
+        jobs = min(self.jobs, len(parts))
+        nproc = str(max(int(self.nproc) // jobs, 1))
+        self.logs.info("start bcl2fastq on %d lane/tile partitions, %d jobs with %s threads each.",
+                       len(parts), jobs, nproc)
+        pool = ThreadPool(jobs)
+        try:
+            dirs = pool.map(self.run_partition, [(n, tiles, nproc)
+                                                 for n, tiles in enumerate(parts)])
+        finally:
+            pool.close()
+            pool.join()
+        self.merge_partitions(dirs)
+        shutil.rmtree(self.partdir)
+
+    def merge_partitions(self, dirs):
+        handles = {}
+        try:
+            for d in dirs:
+                for root, _, files in os.walk(d):
+                    for f in sorted(files):
+                        if not f.endswith(".fastq.gz"):
+                            continue
+                        src = os.path.join(root, f)
+                        rel = os.path.relpath(src, d)
+                        if rel not in handles:
+                            dst = os.path.join(self.outdir, rel)
+                            if not os.path.isdir(os.path.dirname(dst)):
+                                os.makedirs(os.path.dirname(dst))
+                            handles[rel] = open(dst, "wb")
+                        with open(src, "rb") as fi:
+                            shutil.copyfileobj(fi, handles[rel], 1 << 20)
+        finally:
+            for fo in handles.values():
+                fo.close()
+        stats = [os.path.join(d, "Stats/Stats.json") for d in dirs]
+        stats = [j for j in stats if os.path.isfile(j)]
+        if stats:
+            sdir = os.path.join(self.outdir, "Stats")
+            if not os.path.isdir(sdir):
+                os.makedirs(sdir)
+            with open(os.path.join(sdir, "Stats.json"), "w") as fo:
+                json.dump(merge_bcl_stats(stats), fo, indent=2)
+
     def call(self, cmd, run=True):
         self.logs.debug(cmd)
         if not run:
@@ -87,7 +184,54 @@ class BCL(object):
             subprocess.check_call(cmd, shell=isinstance(
                 cmd, str), stdout=out if self.logs.level == 10 else -3, stderr=-2)
         finally:
-            out.close()
+            if out is not sys.stdout:
+                out.close()
+
+    def fastqs(self):
+        pat = re.compile(r"^(.+)_S\d+_R([12])_001\.fastq\.gz$")
+        out = {}
+        for f in os.listdir(self.outdir):
+            m = pat.match(f)
+            if m:
+                out[m.group(1), int(m.group(2))] = os.path.join(self.outdir, f)
+        return out
+
+    def rescue(self, mis=2, threads=1):
+        idx = self.load_samples()
+        barcode, paired = {}, {}
+        for line in idx:
+            bc1 = line[1].encode()
+            barcode.setdefault(bc1, line[0])
+            if self.index == 2:
+                paired[bc1, line[2].encode()] = line[0]
+        fqs = self.fastqs()
+        und = [fqs.get(("Undetermined", r)) for r in (1, 2)]
+        if und[0] is None:
+            self.logs.warning(
+                "no Undetermined fastq found in %s, skip rescue", self.outdir)
+            return Counter()
+        samples = list(dict.fromkeys(i[0] for i in idx))
+        out = [dict((sn, fqs.get((sn, r)) or os.path.join(self.outdir, "%s_S%d_R%d_001.fastq.gz" % (sn, k + 1, r)))
+                    for k, sn in enumerate(samples)) for r in (1, 2)]
+        if und[1] is None:
+            out[1] = {}
+        self.logs.info("rescue Undetermined reads with up to %d index mismatches.", mis)
+        splitter = FastqSplitter(barcode, paired, mis=mis, engine=np is not None and "numpy" or "python",
+                                 source="header")
+        sms = Counter()
+        with MultiZipHandle(mode="ab", threads=threads, **out[0]) as f1:
+            with MultiZipHandle(mode="ab", threads=threads, **out[1]) as f2:
+                for _, res in split_inputs(splitter, [read_batches(*und)], threads):
+                    if res is None:
+                        continue
+                    total, counts, out1, out2, stats = res
+                    for sn, data in out1.items():
+                        f1[sn].write(data)
+                    for sn, data in out2.items():
+                        f2[sn].write(data)
+                    sms.update(counts)
+        self.logs.info("%d Undetermined reads rescued", sum(sms.values()))
+        return sms
 
     def stats(self, j):
         with open(j) as fi:
@@ -103,6 +247,8 @@ class BCL(object):
 
     def run(self):
         self.create_samplesheet()
+        if self.jobs > 1:
+            return self.run_partitions()
         cmd = self.make_bcl_cmd()
         self.cmd = cmd
         # self.logs.info(cmd)
@@ -115,3 +261,378 @@ class BCL(object):
     @property
     def logs(self):
         return logging.getLogger()
+
+
+STATS_KEYS = ("LaneNumber", "Lane", "SampleId",
+              "ReadNumber", "IndexSequence", "Number")
+
+
+def merge_stats(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k, v in b.items():
+            if k not in STATS_KEYS:
+                a[k] = merge_stats(a[k], v) if k in a else v
+        return a
+    if isinstance(a, list) and isinstance(b, list):
+        if not all(isinstance(i, dict) for i in a + b):
+            return a
+        key = [k for k in STATS_KEYS if a and k in a[0]]
+        if not key:
+            return a + b
+        pos = dict((i[key[0]], n) for n, i in enumerate(a))
+        for i in b:
+            if i.get(key[0]) in pos:
+                merge_stats(a[pos[i[key[0]]]], i)
+            else:
+                pos[i.get(key[0])] = len(a)
+                a.append(i)
+        return a
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+        return a + b
+    return a
+
+
+def merge_bcl_stats(paths):
+    out = None
+    for j in paths:
+        with open(j) as fi:
+            stat = json.load(fi)
+        if out is None:
+            out = stat
+            continue
+        for k in ("ConversionResults", "UnknownBarcodes"):
+            if k in stat:
+                out[k] = merge_stats(out.get(k, []), stat[k])
+        lanes = set(i.get("LaneNumber") for i in out.get("ReadInfosForLanes", []))
+        out.setdefault("ReadInfosForLanes", []).extend(
+            i for i in stat.get("ReadInfosForLanes", []) if i.get("LaneNumber") not in lanes)
+    return out
+
+
+class RunInfo(object):
+
+    def __init__(self, fcdir):
+        self.path = os.path.join(fcdir, "RunInfo.xml")
+        if not os.path.isfile(self.path):
+            raise IOError("RunInfo.xml not found in %s" % fcdir)
+        run = ET.parse(self.path).getroot().find("Run")
+        self.number = int(run.get("Number", 0))
+        self.flowcell = run.findtext("Flowcell", "")
+        self.instrument = run.findtext("Instrument", "")
+        self.reads = []
+        cycle = 0
+        for r in sorted(run.find("Reads"), key=lambda r: int(r.get("Number"))):
+            n = int(r.get("NumCycles"))
+            self.reads.append((cycle, cycle + n, r.get("IsIndexedRead") == "Y"))
+            cycle += n
+        self.cycles = cycle
+        layout = run.find("FlowcellLayout")
+        self.lanes = layout is not None and int(layout.get("LaneCount", 1)) or 1
+        self.tiles = [t.text for t in run.iter("Tile")]
+
+    def segments(self, index=False):
+        return [(s, e) for s, e, i in self.reads if i == index]
+
+
+def read_bcl(path):
+    op = path.endswith(".gz") and gzip.open or open
+    with op(path, "rb") as fi:
+        data = fi.read()
+    n = struct.unpack_from("<I", data)[0]
+    return np.frombuffer(data, dtype=np.uint8, count=n, offset=4)
+
+
+def read_filter(path):
+    with open(path, "rb") as fi:
+        data = fi.read()
+    zero, version, n = struct.unpack_from("<III", data)
+    offset = 12
+    if zero:
+        n, offset = zero, 4
+    return np.frombuffer(data, dtype=np.uint8, count=n, offset=offset) & 1 == 1
+
+
+def read_locs(path):
+    with open(path, "rb") as fi:
+        data = fi.read()
+    n = struct.unpack_from("<I", data, 8)[0]
+    xy = np.frombuffer(data, dtype="<f4", count=2*n, offset=12).reshape(n, 2)
+    return np.rint(xy * 10 + 1000).astype(np.int64)
+
+
+class CbclFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fi:
+            version, size, bbits, qbits, nbins = struct.unpack(
+                "<HIBBI", fi.read(12))
+            head = fi.read(size - 12)
+        if bbits != 2 or qbits > 6:
+            raise IOError("unsupported cbcl file %s" % path)
+        bins = struct.unpack_from("<%dI" % (nbins * 2), head)
+        self.qual = np.arange(1 << qbits, dtype=np.uint8)
+        for i in range(nbins):
+            self.qual[bins[2*i]] = bins[2*i+1]
+        pos = nbins * 8
+        ntiles = struct.unpack_from("<I", head, pos)[0]
+        pos += 4
+        self.tiles = {}
+        offset = size
+        for _ in range(ntiles):
+            tile, n, usize, csize = struct.unpack_from("<IIII", head, pos)
+            self.tiles[tile] = (n, offset, csize)
+            offset += csize
+            pos += 16
+        self.excluded = bool(head[pos])
+
+    def tile(self, tile):
+        if tile not in self.tiles:
+            raise IOError("tile %d not found in %s" % (tile, self.path))
+        n, offset, csize = self.tiles[tile]
+        with open(self.path, "rb") as fi:
+            fi.seek(offset)
+            data = zlib.decompress(fi.read(csize), 31)
+        arr = np.frombuffer(data, dtype=np.uint8)
+        nib = np.empty(len(arr) * 2, dtype=np.uint8)
+        nib[0::2] = arr & 15
+        nib[1::2] = arr >> 4
+        nib = nib[:n]
+        out = (self.qual[nib >> 2] << 2) | (nib & 3)
+        out[nib == 0] = 0
+        return out
+
+
+BASE_LUT = np.frombuffer(b"ACGT", dtype=np.uint8)[
+    np.arange(256) & 3] if np is not None else None
+QUAL_LUT = ((np.arange(256) >> 2) + 33).astype(np.uint8) if np is not None else None
+if np is not None:
+    BASE_LUT[0], QUAL_LUT[0] = ord("N"), ord("#")
+
+_demux = None
+
+
+def _init_demux(demux):
+    global _demux
+    _demux = demux
+
+
+def _convert_tile(tile):
+    return _demux.convert(*tile)
+
+
+class BCLDemux(BCL):
+
+    def __init__(self, fcdir, outdir, bcfile, cpu=10, mis=1, rc_i7=False, rc_i5=False, mode="auto", logfile=None, **kw):
+        super(BCLDemux, self).__init__(fcdir, outdir, bcfile, cpu=cpu, mis=mis, rc_i7=rc_i7,
+                                       rc_i5=rc_i5, mode=mode, logfile=logfile)
+        if np is None:
+            raise ImportError("numpy is required for native bcl demultiplexing")
+        self.cpu = cpu
+        self.basecalls = os.path.join(fcdir, "Data/Intensities/BaseCalls")
+        self.cbcl = {}
+
+    def setup(self):
+        self.info = RunInfo(self.fcdir)
+        idx = self.load_samples()
+        self.samples = [i[0] for i in idx]
+        iseg = self.info.segments(index=True)
+        if len(iseg) < self.index:
+            raise IOError("%d index reads in RunInfo.xml, %d needed by %s" % (
+                len(iseg), self.index, self.bcfile))
+        bc1 = list(dict.fromkeys(i[1].encode() for i in idx))
+        self.index1 = barcode_index(bc1, int(self.mis), "numpy")
+        self.index2 = None
+        ids2 = [0] * len(idx)
+        if self.index == 2:
+            bc2 = list(dict.fromkeys(i[2].encode() for i in idx))
+            self.index2 = barcode_index(bc2, int(self.mis), "numpy")
+            ids2 = [bc2.index(i[2].encode()) for i in idx]
+        self.table = np.full((len(bc1), max(ids2) + 1), -1, dtype=np.int64)
+        for n, (i, j) in enumerate(zip([bc1.index(i[1].encode()) for i in idx], ids2)):
+            if self.table[i, j] >= 0:
+                raise IOError("index %s used by both %s and %s" % (
+                    "+".join(idx[n][1:]), self.samples[self.table[i, j]], self.samples[n]))
+            self.table[i, j] = n
+        self.iseg = iseg[:self.index]
+        self.rseg = self.info.segments(index=False)
+        self.prefix = ("@%s:%d:%s:" % (self.info.instrument, self.info.number,
+                                       self.info.flowcell)).encode()
+
+    def tiles(self):
+        out = []
+        for lane in range(1, self.info.lanes + 1):
+            ldir = os.path.join(self.basecalls, "L%03d" % lane)
+            if not os.path.isdir(ldir):
+                continue
+            pat = re.compile(r"s_%d_(\d+)\.filter$" % lane)
+            found = sorted(int(m.group(1)) for m in map(pat.match, os.listdir(ldir)) if m)
+            if not found:
+                found = sorted(int(t.split("_")[1]) for t in self.info.tiles
+                               if t.split("_")[0] == str(lane))
+            out.extend((lane, t) for t in found)
+        if not out:
+            raise IOError("no tiles found in %s" % self.basecalls)
+        return out
+
+    def cycle(self, lane, tile, c):
+        cdir = os.path.join(self.basecalls, "L%03d" % lane, "C%d.1" % c)
+        for ext in (".bcl", ".bcl.gz"):
+            path = os.path.join(cdir, "s_%d_%d%s" % (lane, tile, ext))
+            if os.path.isfile(path):
+                return read_bcl(path), False
+        path = os.path.join(cdir, "L%03d_%d.cbcl" % (lane, tile // 1000))
+        if os.path.isfile(path):
+            if path not in self.cbcl:
+                self.cbcl[path] = CbclFile(path)
+            cb = self.cbcl[path]
+            return cb.tile(tile), cb.excluded
+        raise IOError("no bcl file for lane %d tile %d cycle %d in %s" % (
+            lane, tile, c, cdir))
+
+    def locs(self, lane, tile, n):
+        for path in (os.path.join(self.fcdir, "Data/Intensities/L%03d/s_%d_%d.locs" % (lane, lane, tile)),
+                     os.path.join(self.fcdir, "Data/Intensities/s.locs")):
+            if os.path.isfile(path):
+                xy = read_locs(path)
+                if len(xy) == n:
+                    return xy
+        xy = np.zeros((n, 2), dtype=np.int64)
+        xy[:, 0] = np.arange(n)
+        return xy
+
+    def load(self, lane, tile):
+        fpath = os.path.join(self.basecalls, "L%03d" % lane,
+                             "s_%d_%d.filter" % (lane, tile))
+        pf = read_filter(fpath) if os.path.isfile(fpath) else None
+        calls = None
+        for c in range(self.info.cycles):
+            arr, excluded = self.cycle(lane, tile, c + 1)
+            if pf is not None and not excluded:
+                if len(arr) != len(pf):
+                    raise IOError("lane %d tile %d cycle %d has %d clusters, filter has %d" % (
+                        lane, tile, c + 1, len(arr), len(pf)))
+                arr = arr[pf]
+            if calls is None:
+                calls = np.empty((self.info.cycles, len(arr)), dtype=np.uint8)
+            elif len(arr) != calls.shape[1]:
+                raise IOError("lane %d tile %d cycle %d has %d clusters, %d expected" % (
+                    lane, tile, c + 1, len(arr), calls.shape[1]))
+            calls[c] = arr
+        n = len(pf) if pf is not None else calls.shape[1]
+        xy = self.locs(lane, tile, n)
+        if pf is not None and len(xy) == len(pf):
+            xy = xy[pf]
+        return calls, xy
+
+    def demux(self, bases):
+        n = bases.shape[1]
+        ids = []
+        for (s, e), index in zip(self.iseg, (self.index1, self.index2)):
+            pre = np.zeros((n, index.width), dtype=np.uint8)
+            w = min(e - s, index.width)
+            pre[:, :w] = bases[s:s+w].T
+            ids.append(index.match_matrix(pre))
+        id1 = ids[0]
+        id2 = ids[1] if len(ids) > 1 else np.zeros(n, dtype=np.int64)
+        ok = (id1 >= 0) & (id2 >= 0)
+        sid = np.full(n, -1, dtype=np.int64)
+        sid[ok] = self.table[id1[ok], id2[ok]]
+        return sid, int((ok & (sid < 0)).sum())
+
+    def convert(self, lane, tile):
+        calls, xy = self.load(lane, tile)
+        bases, quals = BASE_LUT[calls], QUAL_LUT[calls]
+        del calls
+        sid, hopped = self.demux(bases)
+        keep = np.flatnonzero(sid >= 0)
+        keep = keep[np.argsort(sid[keep], kind="stable")]
+        sid = sid[keep]
+        counts = np.bincount(sid, minlength=len(self.samples))
+        if self.iseg:
+            parts = [bases[s:e, keep].T for s, e in self.iseg]
+            if len(parts) == 2:
+                parts.insert(1, np.full((len(keep), 1), ord("+"), dtype=np.uint8))
+            tag = np.concatenate(parts, axis=1)
+            tw = tag.shape[1]
+            tag = tag.tobytes()
+            tags = [tag[i:i+tw] for i in range(0, len(tag), tw)]
+        else:
+            tags = [b""] * len(keep)
+        prefix = self.prefix + b"%d:%d:" % (lane, tile)
+        names = [b"%s%d:%d " % (prefix, x, y) for x, y in xy[keep].tolist()]
+        bounds = np.searchsorted(sid, np.arange(len(self.samples) + 1)).tolist()
+        out = {}
+        for r, (s, e) in enumerate(self.rseg):
+            L = e - s
+            body = np.empty((len(keep), 2 * L + 4), dtype=np.uint8)
+            body[:, :L] = bases[s:e, keep].T
+            body[:, L:L+3] = np.frombuffer(b"\n+\n", dtype=np.uint8)
+            body[:, L+3:2*L+3] = quals[s:e, keep].T
+            body[:, -1] = 10
+            w = body.shape[1]
+            body = body.tobytes()
+            head = b"%d:N:0:" % (r + 1)
+            for k, sn in enumerate(self.samples):
+                if bounds[k] == bounds[k+1]:
+                    continue
+                data = b"".join(b"%s%s%s\n%s" % (names[i], head, tags[i], body[i*w:(i+1)*w])
+                                for i in range(bounds[k], bounds[k+1]))
+                out[k, r] = b"".join(bgzf_block(data[i:i+BGZF_BLOCK_SIZE])
+                                     for i in range(0, len(data), BGZF_BLOCK_SIZE))
+        return lane, tile, counts, bases.shape[1], hopped, out
+
+    def outfile(self, k, r):
+        return os.path.join(self.outdir, "%s_S%d_R%d_001.fastq.gz" % (self.samples[k], k + 1, r + 1))
+
+    def run(self):
+        self.setup()
+        tiles = self.tiles()
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        self.logs.info("start native bcl demultiplexing, %d tiles, %d cycles, %d samples.",
+                       len(tiles), self.info.cycles, len(self.samples))
+        handles = {}
+        counts = np.zeros(len(self.samples), dtype=np.int64)
+        total = hopped = 0
+        pool = mp.Pool(max(1, min(self.cpu, len(tiles))),
+                       initializer=_init_demux, initargs=(self,))
+        try:
+            for lane, tile, c, n, h, out in pool.imap(_convert_tile, tiles):
+                for (k, r), data in sorted(out.items()):
+                    if (k, r) not in handles:
+                        handles[k, r] = open(self.outfile(k, r), "wb")
+                    handles[k, r].write(data)
+                counts += c
+                total += n
+                hopped += h
+                self.logs.debug("lane %d tile %d done, %d clusters", lane, tile, n)
+            pool.close()
+            for k in range(len(self.samples)):
+                for r in range(len(self.rseg)):
+                    if (k, r) not in handles:
+                        handles[k, r] = open(self.outfile(k, r), "wb")
+                    handles[k, r].write(BGZF_EOF)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            for fo in handles.values():
+                fo.close()
+        self.write_stats(counts, total, hopped)
+
+    def write_stats(self, counts, total, hopped):
+        res = {"Flowcell": self.info.flowcell, "RunNumber": self.info.number,
+               "ConversionResults": [{
+                   "TotalClustersPF": total,
+                   "DemuxResults": [{"SampleId": sn, "SampleName": sn, "NumberReads": int(n)}
+                                    for sn, n in zip(self.samples, counts)],
+                   "Undetermined": {"NumberReads": int(total - counts.sum())},
+                   "IndexHopping": {"NumberReads": hopped},
+               }]}
+        sdir = os.path.join(self.outdir, "Stats")
+        if not os.path.isdir(sdir):
+            os.makedirs(sdir)
+        with open(os.path.join(sdir, "Stats.json"), "w") as fo:
+            json.dump(res, fo, indent=2)
@@ -0,0 +1,54 @@
+from .utils import *
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, interval=600, inputs=None, settings=None):
+        self.path = path
+        self.interval = interval
+        self.inputs = [[i and os.path.abspath(i) for i in fqs] for fqs in inputs or []]
+        self.settings = settings or {}
+        self.last = time.time()
+
+    def load(self, outputs):
+        if not os.path.isfile(self.path):
+            raise IOError("no checkpoint to resume: %s" % self.path)
+        with open(self.path) as fi:
+            state = json.load(fi)
+        if state["inputs"] != self.inputs:
+            raise IOError("checkpoint %s was written for other inputs" % self.path)
+        for k, v in self.settings.items():
+            if state["settings"].get(k) != v:
+                raise IOError("checkpoint %s was written with different %s: %s" % (
+                    self.path, k, state["settings"].get(k)))
+        if sorted(state["outputs"]) != sorted(outputs):
+            raise IOError("checkpoint %s was written for other samples" % self.path)
+        for f, size in state["outputs"].items():
+            if (os.path.isfile(f) and os.path.getsize(f) or 0) < size:
+                raise IOError("%s is shorter than checkpoint %s" % (f, self.path))
+            if os.path.isfile(f):
+                with open(f, "r+b") as fo:
+                    fo.truncate(size)
+        self.logs.info("resume from %s, %d reads written",
+                       self.path, state["total"])
+        return state
+
+    def due(self):
+        return self.interval > 0 and time.time() - self.last >= self.interval
+
+    def save(self, state):
+        # renamed over atomically, a kill never leaves a partial checkpoint
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fo:
+            json.dump(dict(state, inputs=self.inputs,
+                           settings=self.settings), fo, indent=2)
+        os.rename(tmp, self.path)
+        self.last = time.time()
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    @property
+    def logs(self):
+        return logging.getLogger()
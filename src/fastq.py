@@ -0,0 +1,214 @@
+from itertools import repeat
+
+from .utils import *
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        total = 0
+        for i in iterable:
+            total += i
+            yield total
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BLOCK_SIZE = 1 << 24
+
+
+class FastqBlock(object):
+
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+
+    def __len__(self):
+        return (len(self.pos) - 1) // 4
+
+    @property
+    def nbytes(self):
+        return self.pos[-1] - self.pos[0]
+
+    def seqs(self, width):
+        buf, pos = self.buf, self.pos
+        return [buf[s:s+width] for s in pos[1:-1:4]]
+
+    def regions(self, start, end):
+        buf, pos = self.buf, self.pos
+        return [buf[min(s+start, e-1):min(s+end, e-1)] for s, e in zip(pos[1::4], pos[2::4])]
+
+    def prefixes(self, width, offset=0, end=None, rows=None):
+        starts = np.asarray(self.pos[1:-1:4], dtype=np.int64)
+        if rows is not None:
+            starts = starts[rows]
+        arr = np.frombuffer(self.buf, dtype=np.uint8)
+        idx = np.minimum(starts[:, None] + (offset + np.arange(width)),
+                         max(len(arr) - 1, 0))
+        pre = arr[idx]
+        if end is not None:
+            ends = np.asarray(self.pos[2::4], dtype=np.int64)
+            if rows is not None:
+                ends = ends[rows]
+            seqlen = ends - starts - 1
+            pre[np.arange(width) >= (np.minimum(seqlen, end) - offset)[:, None]] = 0
+        return pre
+
+    def names(self):
+        buf, pos = self.buf, self.pos
+        return [buf[s:e] for s, e in zip(pos[0:-1:4], pos[1::4])]
+
+    def name(self, i):
+        return read_name(self.buf[self.pos[4*i]:self.pos[4*i+1]])
+
+
+def read_name(line):
+    parts = line[1:].split(None, 1)
+    name = parts and parts[0] or b""
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
+
+def interleave_records(data1, data2):
+    lines1, lines2 = data1.split(b"\n"), data2.split(b"\n")
+    out = []
+    for i in range(0, len(lines1) - 1, 4):
+        out.extend(lines1[i:i+4])
+        out.extend(lines2[i:i+4])
+    out.append(b"")
+    return b"\n".join(out)
+
+
+def check_mates(block1, block2, name1="", name2="", offset=0):
+    n1, n2 = len(block1), block2 is not None and len(block2) or 0
+    if n2 < n1:
+        raise IOError("paired fastq %s has fewer records than %s (record %d)" % (
+            name2, name1, offset + n2 + 1))
+    if n2 > n1:
+        raise IOError("paired fastq %s has more records than %s (record %d)" % (
+            name2, name1, offset + n1 + 1))
+    for i in n1 and set((0, n1 // 2, n1 - 1)) or ():
+        a, b = block1.name(i), block2.name(i)
+        if a != b:
+            raise IOError("paired read names differ at record %d: %s (%s) vs %s (%s)" % (
+                offset + i + 1, a.decode(errors="replace"), name1,
+                b.decode(errors="replace"), name2))
+
+
+def record_start(buf, p, end=None):
+    # first '@' line at or after p with a '+' line two lines later
+    end = end or len(buf)
+    if p <= 0:
+        return 0
+    q = buf.find(b"\n", p - 1, end) + 1
+    while 0 < q < end:
+        ends = []
+        for _ in range(4):
+            e = buf.find(b"\n", ends and ends[-1] + 1 or q, end)
+            ends.append(e < 0 and end or e)
+            if e < 0:
+                break
+        if len(ends) < 3:
+            break
+        if buf[q:q+1] == b"@" and buf[ends[1]+1:ends[1]+2] == b"+" and \
+                len(ends) == 4 and ends[3] - ends[2] == ends[1] - ends[0]:
+            return q
+        q = ends[0] + 1
+    return end
+
+
+class FastqParser(object):
+
+    def __init__(self, fh, name="", block=BLOCK_SIZE):
+        self.fh = fh
+        self.name = name
+        self.block = block
+        self.rest = b""
+        self.eof = False
+        self.nrec = 0
+        self.offset = 0
+
+    def error(self, buf, pos, what):
+        i = (len(pos) - 1) // 4
+        raise IOError("malformed fastq record %d (byte %d) in %s: %s" % (
+            self.nrec + i + 1, self.offset + pos[-1], self.name, what))
+
+    def parse(self, buf, start=0, limit=None, end=None):
+        if np is not None:
+            return self._parse_numpy(buf, start, limit, end)
+        lines = buf[start:end].split(b"\n")
+        k = (len(lines) - 1) // 4
+        if limit is not None:
+            k = min(k, limit)
+        lines = lines[:k*4]
+        head = all(map(bytes.startswith, lines[0::4], repeat(b"@", k)))
+        sep = all(map(bytes.startswith, lines[2::4], repeat(b"+", k)))
+        qual = list(map(len, lines[1::4])) == list(map(len, lines[3::4]))
+        pos = [start]
+        pos.extend(start + p + n + 1 for n,
+                   p in enumerate(accumulate(map(len, lines))))
+        if not (head and sep and qual):
+            for i in range(0, k*4, 4):
+                if not lines[i].startswith(b"@"):
+                    self.error(buf, pos[:i+1], "header line not start with '@'")
+                if not lines[i+2].startswith(b"+"):
+                    self.error(buf, pos[:i+1], "separator line not start with '+'")
+                if len(lines[i+1]) != len(lines[i+3]):
+                    self.error(buf, pos[:i+1], "sequence and quality length differ")
+        return pos
+
+    def _parse_numpy(self, buf, start, limit, end=None):
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        nl = np.flatnonzero(arr[start:end] == 10)
+        k = len(nl) // 4
+        if limit is not None:
+            k = min(k, limit)
+        ends = nl[:k*4].reshape(k, 4) + (start + 1)
+        rs = np.empty(k, dtype=np.int64)
+        rs[:1] = start
+        rs[1:] = ends[:-1, 3]
+        head = arr[rs] == 64
+        sep = arr[ends[:, 1]] == 43
+        qual = ends[:, 1] - ends[:, 0] == ends[:, 3] - ends[:, 2]
+        ok = head & sep & qual
+        if not ok.all():
+            i = int(np.argmin(ok))
+            pos = [start] + ends[:i].ravel().tolist()
+            if not head[i]:
+                self.error(buf, pos, "header line not start with '@'")
+            if not sep[i]:
+                self.error(buf, pos, "separator line not start with '+'")
+            self.error(buf, pos, "sequence and quality length differ")
+        pos = [start]
+        pos.extend(ends.ravel().tolist())
+        return pos
+
+    def read(self, n=None):
+        buf = self.rest
+        pos = self.parse(buf, 0, n)
+        while True:
+            k = (len(pos) - 1) // 4
+            if self.eof or (k if n is None else k >= n):
+                break
+            data = self.fh.read(self.block)
+            if not data:
+                self.eof = True
+                if buf and not buf.endswith(b"\n"):
+                    buf += b"\n"
+            else:
+                buf = buf + data
+            more = self.parse(buf, pos[-1], n and n - k)
+            pos.extend(more[1:])
+        end = pos[-1]
+        self.rest = buf[end:]
+        if self.eof and self.rest.strip() and (n is None or k < n):
+            raise IOError("truncated fastq record %d (byte %d) in %s" % (
+                self.nrec + k + 1, self.offset + end, self.name))
+        self.nrec += k
+        self.offset += end
+        if not k:
+            return None
+        return FastqBlock(buf, pos)
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # coding:utf-8
 
-from .src import *
 from .bcl import *
+from .split import *
 
 
 @timeRecord
@@ -12,33 +12,50 @@ def main():
     if args.debug:
         logs.setLevel(logging.DEBUG)
     infq = args.input
-    if not os.path.exists(infq):
+    if args.command == "split":
+        inputs = load_inputs(args.input, args.Input, args.manifest)
+        pe = inputs[0][1] is not None
+    elif not os.path.exists(infq):
         raise IOError("No such file or directory: %s" % infq)
     logs.info("start fsplit")
     if args.command == "index":
-        FastqIndex.createindex(args.input)
+        if infq.endswith(".gz"):
+            GzipIndex.create(infq, span=args.span << 20)
+        else:
+            logs.info("plain fastq is split through mmap, no index is needed")
         return
     outdir = os.path.abspath(args.output)
     if args.command == "bcl2fq":
         if os.path.isdir(os.path.join(infq, "Data/Intensities/BaseCalls")):
-            bcl2fastq = args.bcl2fq or which("bcl2fastq")
-            if not (bcl2fastq and os.path.isfile(bcl2fastq)):
-                sys.exit("bcl2fastq not found, exit")
             kw = {
                 "cpu": args.threads,
-                "bcl2fastq": bcl2fastq,
                 "mis": args.mismatch,
                 "rc_i7": args.rc_index1,
                 "rc_i5": args.rc_index2,
                 "mode": args.mode,
                 "logfile": args.log,
             }
-            bcl = BCL(infq, outdir, args.sample, **kw)
+            if args.engine == "bcl":
+                if np is None:
+                    sys.exit("numpy is required by '--engine bcl', exit")
+                bcl = BCLDemux(infq, outdir, args.sample, **kw)
+            else:
+                bcl2fastq = args.bcl2fq or which("bcl2fastq")
+                if not (bcl2fastq and os.path.isfile(bcl2fastq)):
+                    sys.exit("bcl2fastq not found, exit")
+                bcl = BCL(infq, outdir, args.sample, bcl2fastq=bcl2fastq,
+                          jobs=args.jobs, retries=args.retries, **kw)
             bcl.run()
+            rescued = None
+            if args.rescue is not None:
+                if args.engine == "bcl":
+                    logs.warning("--rescue ignored with '--engine bcl'")
+                else:
+                    rescued = bcl.rescue(args.rescue, args.threads)
             logs.info("Success")
             js = os.path.join(outdir, "Stats/Stats.json")
             if os.path.isfile(js):
-                stats = load_bcl_stats(js)
+                stats = load_bcl_stats(js, rescued)
                 logs.info(stats)
             rmpdir = ["Stats", "Reports",
                       "sample-sheet.csv", "Undetermined*.gz"]
@@ -54,18 +71,23 @@ def main():
     # outfile = {"Unknow": os.path.join(outdir, "Unknow.fq")}
     outfile = {}
     outfile_paired = {}
+    dual = False
     with open(args.barcode) as fi:
         for line in fi:
             if not line.strip() or line.strip().startswith("#"):
                 continue
             line = line.split()
-            sn, bc = line[0], line[1]
+            sn, bc = line[0], line[-1] if len(line) == 1 else line[1]
             bc1 = args.rc_bc1 and rc_seq(bc).encode() or bc.encode()
-            barcode[bc1] = sn
             bc2 = len(line) == 3 and line[2] or bc
-            barcode_paired[bc1] = args.rc_bc2 and rc_seq(
-                bc2).encode() or bc2.encode()
-            if args.Input:
+            dual = dual or len(line) == 3
+            bc2 = args.rc_bc2 and rc_seq(bc2).encode() or bc2.encode()
+            if barcode_paired.get((bc1, bc2), sn) != sn:
+                raise IOError("barcode %s+%s used by both %s and %s" % (
+                    bc1.decode(), bc2.decode(), barcode_paired[bc1, bc2], sn))
+            barcode_paired[bc1, bc2] = sn
+            barcode.setdefault(bc1, sn)
+            if pe and not args.output_cmd:
                 outfile[sn] = os.path.join(outdir, sn+".R1.fq")
                 outfile_paired[sn] = os.path.join(outdir, sn+".R2.fq")
             else:
@@ -75,86 +97,201 @@ def main():
                 if sn in outfile_paired:
                     outfile_paired[sn] += ".gz"
 
-    drup_pos = dict.fromkeys(list(barcode.keys()) +
-                             list(barcode_paired.values()), 0)
-    if args.drup:
-        for bc in barcode.keys():
-            drup_pos[bc] = len(bc)
-        for bcp in barcode_paired.values():
-            drup_pos[bcp] = len(bcp)
-
-    mis = args.mismatch
+    engine = args.engine
+    if args.qc and np is None:
+        sys.exit("numpy is required by --qc, exit")
+    if engine == "whitelist" and np is None:
+        sys.exit("numpy is required for whitelist barcode matching, exit")
+    if engine == "numpy" and np is None:
+        logs.warning("numpy not installed, fall back to python barcode matching")
+        engine = "python"
+    paired = pe and barcode_paired or None
+    if args.barcode_source == "header":
+        paired = dual and barcode_paired or None
+        if args.drup:
+            logs.warning(
+                "-d/--drup ignored with --barcode-source header, records are written unchanged")
+        if args.umi:
+            logs.warning(
+                "--umi ignored with --barcode-source header, records are written unchanged")
+            args.umi = None
+    if not paired and len(barcode) < len(set(barcode_paired.values())):
+        raise IOError(
+            "samples share barcode1, combinatorial barcodes need dual index from paired input or --barcode-source header")
+    report = RunReport(enabled=args.profile or bool(args.report))
+    splitter = FastqSplitter(barcode, paired, mis=args.mismatch, drup=args.drup, engine=engine,
+                             profile=report.enabled, cache=args.barcode, source=args.barcode_source,
+                             window=args.barcode_window, qc=args.qc, umi=args.umi)
     sms = Counter()
+    hopped = Counter()
     total_seq = 0
-    if not args.Input:
-        with MultiZipHandle(mode="wb", **outfile) as fh:
-            with Zopen(infq, gzip=True) as fi:
-                seq = [None] * 4
-                for n, line in enumerate(fi):
-                    ni = n % 4
-                    seq[ni] = line
-                    if ni == 3:
-                        for b, sn in barcode.items():
-                            d = 0
-                            for n, i in enumerate(b):
-                                if i != seq[1][n]:
-                                    d += 1
-                                if d > mis:
-                                    break
-                            else:
-                                dp = drup_pos[b]
-                                seq[1] = seq[1][dp:]
-                                seq[3] = seq[3][dp:]
-                                fh[sn].writelines(seq)
-                                sms[sn] += 1
-                                break
-                        total_seq += 1
+    qcs = ({}, {})
+    by_input = [Counter() for _ in inputs]
+    input_total = [0] * len(inputs)
+    cur = 0
+    pipes = bool(args.output_cmd) or any(
+        map(is_stream, list(outfile.values()) + list(outfile_paired.values())))
+    ckpt = None
+    skips = None
+    parts = args.shard_reads is not None or args.shard_bytes is not None
+    if args.shard_reads is not None and args.shard_bytes is not None:
+        raise IOError("--shard-reads and --shard-bytes are exclusive")
+    if args.shard_reads is not None and args.shard_reads < 1:
+        raise IOError("--shard-reads needs a positive number")
+    if parts and pipes:
+        raise IOError("--shard-reads/--shard-bytes need file outputs, not pipes")
+    if parts and args.resume:
+        raise IOError("--resume is not supported with --shard-reads/--shard-bytes")
+    if pipes or parts or any(is_stream(fq) for fqs in inputs for fq in fqs if fq):
+        if args.resume:
+            raise IOError("--resume needs regular input and output files")
+    else:
+        settings = {
+            "barcode": os.path.abspath(args.barcode),
+            "mismatch": args.mismatch,
+            "drup": args.drup,
+            "rc_bc1": args.rc_bc1,
+            "rc_bc2": args.rc_bc2,
+            "output_gzip": args.output_gzip,
+            "output_cmd": args.output_cmd,
+            "barcode_source": args.barcode_source,
+            "barcode_window": args.barcode_window and list(args.barcode_window),
+            "qc": args.qc,
+            "umi": args.umi and list(args.umi),
+        }
+        ckpt = Checkpoint(os.path.join(outdir, "checkpoint.json"),
+                          args.checkpoint, inputs, settings)
+    if args.resume:
+        state = ckpt.load(list(outfile.values()) +
+                          list(outfile_paired.values()))
+        cur, input_total, total_seq = state["input"], state["records"], state["total"]
+        sms.update(state["sms"])
+        for qc, st in zip(qcs, state["qc"]):
+            qc.update((sn, ReadQC.fromstate(d)) for sn, d in st.items())
+        for n, c in enumerate(state["by_input"]):
+            by_input[n].update(c)
+        hopped.update(dict(((bc1.encode(), bc2.encode()), num)
+                      for bc1, bc2, num in state["hopped"]))
+        skips = [input_total[n] if n >= cur else None for n in range(len(inputs))]
+    sources = input_sources(inputs, args.threads, report, skips)
+    if all(isinstance(src, list) and src and isinstance(src[0], IndexedBatch) for src in sources):
+        report.total_reads = sum(b.num for src in sources for b in src)
+    shard = None
+    jobs = args.input_jobs
+    # paired reads share one command, interleaved for aligners reading stdin
+    interleaved = pe and bool(args.output_cmd)
+    mode = args.resume and "ab" or "wb"
+    if pipes:
+        # pipes are fed from memory, inputs one by one keep it bounded
+        jobs = 1
+        w1 = PipeOutput(args.output_cmd, args.output_gzip, outdir, **outfile)
+        w2 = PipeOutput(args.output_cmd, args.output_gzip, outdir, **outfile_paired)
+    elif parts:
+        # parts are fed from memory, inputs one by one keep it bounded
+        jobs = 1
+        # parts are cut from whole records in this process, R2 parts follow
+        # the R1 record counts
+        manifest = PartManifest(os.path.join(outdir, "parts.tsv"), outfile_paired and 2 or 1)
+        max_open = args.max_open and max(1, args.max_open // (pe and 2 or 1))
+        w1 = PartOutput(args.shard_reads, args.shard_bytes, manifest,
+                        threads=args.threads, max_open=max_open, **outfile)
+        w2 = PartOutput(args.shard_reads, args.shard_bytes, manifest, w1,
+                        threads=args.threads, max_open=max_open, **outfile_paired)
+    elif args.threads > 1:
+        # workers write their own shard files, appended here in batch order
+        shard = ShardWriter(os.path.join(outdir, ".shards"), args.output_gzip)
+        shutil.rmtree(shard.tmpdir, ignore_errors=True)
+        os.makedirs(shard.tmpdir)
+        w1 = ShardOutput(args.output_gzip, mode, **outfile)
+        w2 = ShardOutput(args.output_gzip, mode, **outfile_paired)
     else:
-        with MultiZipHandle(mode="wb", **outfile) as f1:
-            with MultiZipHandle(mode="wb", **outfile_paired) as f2:
-                seq1 = [None] * 4
-                seq2 = [None] * 4
-                with Zopen(infq, gzip=True) as fq1, Zopen(args.Input, gzip=True) as fq2:
-                    for n, line in enumerate(fq1):
-                        ni = n % 4
-                        seq1[ni] = line
-                        seq2[ni] = fq2.readline()
-                        if ni == 3:
-                            for b, sn in barcode.items():
-                                d = 0
-                                for n, i in enumerate(b):
-                                    if i != seq1[1][n]:
-                                        d += 1
-                                    if d > mis:
-                                        break
-                                else:
-                                    d2 = 0
-                                    b2 = barcode_paired[b]
-                                    for n, i in enumerate(b2):
-                                        if i != seq2[1][n]:
-                                            d2 += 1
-                                        if d2 > mis:
-                                            break
-                                    else:
-                                        seq1[1] = seq1[1][drup_pos[b]:]
-                                        seq1[3] = seq1[3][drup_pos[b]:]
-                                        seq2[1] = seq2[1][drup_pos[b2]:]
-                                        seq2[3] = seq2[3][drup_pos[b2]:]
-                                        f1[sn].writelines(seq1)
-                                        f2[sn].writelines(seq2)
-                                        sms[sn] += 1
-                                    break
-                            total_seq += 1
+        max_open = args.max_open and max(1, args.max_open // (pe and 2 or 1))
+        w1 = MultiZipHandle(mode=mode, threads=args.threads,
+                            max_open=max_open, **outfile)
+        w2 = MultiZipHandle(mode=mode, threads=args.threads,
+                            max_open=max_open, **outfile_paired)
+    with w1 as f1, w2 as f2:
+        # later inputs are held until earlier ones are written, so outputs
+        # follow the input order
+        held = defaultdict(list)
+        done = set()
+        try:
+            for n, res in split_inputs(splitter, sources, args.threads, shard, jobs):
+                if res is None:
+                    done.add(n)
+                else:
+                    held[n].append(res)
+                while held[cur] or cur in done:
+                    if not held[cur]:
+                        cur += 1
+                        continue
+                    total, counts, out1, out2, stats = held[cur].pop(0)
+                    t = report.enabled and clock()
+                    if interleaved:
+                        out1 = dict((sn, interleave_records(data, out2[sn]))
+                                    for sn, data in out1.items())
+                        out2 = {}
+                    for sn, data in out1.items():
+                        f1[sn].write(data)
+                    for sn, data in out2.items():
+                        f2[sn].write(data)
+                    sms.update(counts)
+                    by_input[cur].update(counts)
+                    input_total[cur] += total
+                    hopped.update(stats.pop("hopped", ()))
+                    for qc, part in zip(qcs, stats.pop("qcs", ())):
+                        merge_qc(qc, part)
+                    total_seq += total
+                    if t:
+                        elapsed(t, report.stages, "write")
+                        report.update(total, stats, sum(map(len, out1.values())) +
+                                      sum(map(len, out2.values())))
+                    if ckpt is not None and ckpt.due():
+                        outputs = w1.sync()
+                        outputs.update(w2.sync())
+                        ckpt.save({
+                            "input": cur,
+                            "records": input_total,
+                            "total": total_seq,
+                            "sms": sms,
+                            "by_input": by_input,
+                            "hopped": [(bc1.decode(), bc2.decode(), num) for (bc1, bc2), num in hopped.items()],
+                            "outputs": outputs,
+                            "qc": [dict((sn, q.state()) for sn, q in qc.items()) for qc in qcs],
+                        })
+        finally:
+            if shard is not None:
+                shutil.rmtree(shard.tmpdir, ignore_errors=True)
 
+    if ckpt is not None:
+        ckpt.remove()
     logs.info("Success")
     sys.stdout.write("\n")
     sms["Unknow"] = total_seq - sum(sms.values())
-    for sn in sorted(set(barcode.values())):
+    for sn in sorted(outfile):
         num = sms[sn]
         sys.stdout.write("%s: %d(%.2f%%)\n" %
                          (sn, num, round(num/float(total_seq)*100, 2)))
     sys.stdout.write("Unknow: %d(%.2f%%)\n" % (
         sms["Unknow"], round(sms["Unknow"]/float(total_seq)*100, 2)))
+    if paired:
+        write_hopping(os.path.join(outdir, "index_hopping.tsv"),
+                      hopped, barcode_paired, total_seq)
+    if len(inputs) > 1:
+        for c, total in zip(by_input, input_total):
+            c["Unknow"] = total - sum(c.values())
+        write_input_summary(os.path.join(outdir, "input_summary.tsv"),
+                            inputs, by_input, sorted(outfile))
+        report.input_samples = dict(("+".join(i for i in fqs if i), dict(c))
+                                    for fqs, c in zip(inputs, by_input))
+    if args.qc:
+        write_qc(os.path.join(outdir, "qc.json"),
+                 pe and qcs or qcs[:1], sorted(outfile))
+    if report.enabled:
+        report.log_stages()
+    if args.report:
+        report.hopped = sum(hopped.values())
+        report.dump(args.report, sms)
 
 
 def gsplit():
@@ -165,95 +302,5 @@ def gsplit_multi_barcode():
     run_exe("gsplit-multi-barcode")
 
 
-@timeRecord
-def main_idx_multi():
-    logs = log()
-    args = parseArg()
-    if args.debug:
-        logs.setLevel(logging.DEBUG)
-    infq = args.input
-    if not os.path.exists(infq):
-        raise IOError("No such file or directory: %s" % infq)
-    logs.info("start fsplit")
-    if args.command == "index":
-        FastqIndex.createindex(args.input)
-        return
-    outdir = os.path.abspath(args.output)
-    if os.path.isdir(infq):
-        if os.path.isdir(os.path.join(infq, "Data/Intensities/BaseCalls")):
-            bcl2fastq = args.bcl2fq or which("bcl2fastq") or os.path.join(
-                sys.prefix, "bin", "bcl2fastq")
-            if not os.path.isfile(bcl2fastq):
-                sys.exit("bcl2fastq not found, exists")
-            bcl = BCL(infq, outdir, args.barcode, args.threads,
-                      bcl2fastq=bcl2fastq, mis=args.mismatch)
-            bcl.run()
-            logs.info("Success")
-            js = os.path.join(outdir, "Stats/Stats.json")
-            if os.path.isfile(js):
-                stats = load_bcl_stats(js)
-                logs.info(stats)
-            rmpdir = ["Stats", "Reports",
-                      "sample-sheet.csv", "Undetermined*.gz"]
-            clean_fnmatch(outdir, *rmpdir)
-            return
-        else:
-            sys.exit("flowcell directory '%s' incorrection" % infq)
-    if not os.path.isdir(outdir):
-        os.makedirs(outdir)
-    group = args.threads * 5
-
-    mg = mp.Manager()
-    barcode = {}
-    # outfile = {"Unknow": os.path.join(outdir, "Unknow.fq")}
-    filelock = {}
-    outfile = {}
-    with open(args.barcode) as fi:
-        for line in fi:
-            if not line.strip() or line.strip().startswith("#"):
-                continue
-            line = line.split()
-            sn, bc = line[0], line[1]
-            barcode[bc.encode()] = sn
-            outfile[sn] = os.path.join(outdir, sn+".fq")
-            if args.output_gzip:
-                outfile[sn] += ".gz"
-            if os.path.isfile(outfile[sn]):
-                os.remove(outfile[sn])
-            filelock[sn] = mg.Lock()
-    idx = FastqIndex.getIndexPos(infq)
-    size = int(math.ceil(len(idx)/float(group)))
-    l = len(idx)
-    pos = []
-    for i in range(0, len(idx), size):
-        e = min(l-1, i+size)
-        pos.append((idx[i], idx[e]))
-    outQ = mg.Queue()
-    p = mp.Pool(args.threads)
-    for s, e in pos:
-        p_args = tuple([infq, int(s), int(e), outQ, barcode,
-                       args.mismatch, args.drup, outfile, filelock])
-        p.apply_async(splitFastq,  args=p_args)
-
-    sms = Counter()
-    ivs = len(pos)
-    count = 0
-    total_seq = 0
-    for s, e in pos:
-        res = outQ.get()
-        total, snms = res
-        sms.update(snms)
-        total_seq += total
-    logs.info("Success")
-    sys.stdout.write("\n")
-    sms["Unknow"] = total_seq - sum(sms.values())
-    for sn in sorted(barcode.values()):
-        num = sms[sn]
-        sys.stdout.write("%s: %d(%.2f%%)\n" %
-                         (sn, num, round(num/float(total_seq)*100, 2)))
-    sys.stdout.write("Unknow: %d(%.2f%%)\n" % (
-        sms["Unknow"], round(sms["Unknow"]/float(total_seq)*100, 2)))
-
-
 if __name__ == "__main__":
     main()
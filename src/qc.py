@@ -0,0 +1,228 @@
+from .fastq import *
+
+QC_ROWS = 1 << 12
+QC_FOLD = 32
+BASES = "ACGTN"
+
+
+def grow(arr, n):
+    if len(arr) >= n:
+        return arr
+    pad = np.zeros((n - len(arr),) + arr.shape[1:], dtype=arr.dtype)
+    return np.concatenate([arr, pad])
+
+
+class ReadQC(object):
+
+    def __init__(self, reads=0, bases=0, lengths=None, composition=None, quality=None, mismatch=None):
+        self.reads = reads
+        self.bases = bases
+        self.lengths = lengths if lengths is not None else np.zeros(0, dtype=np.int64)
+        self.composition = composition if composition is not None else np.zeros(
+            (0, len(BASES)), dtype=np.int64)
+        self.quality = quality if quality is not None else np.zeros(
+            (0, 3), dtype=np.int64)
+        self.mismatch = mismatch if mismatch is not None else np.zeros(
+            0, dtype=np.int64)
+
+    def add(self, other):
+        self.reads += other.reads
+        self.bases += other.bases
+        for k in ("lengths", "composition", "quality", "mismatch"):
+            a, b = getattr(self, k), getattr(other, k)
+            a = grow(a, len(b))
+            a[:len(b)] += b
+            setattr(self, k, a)
+        return self
+
+    def state(self):
+        return {"reads": self.reads, "bases": self.bases, "lengths": self.lengths.tolist(),
+                "composition": self.composition.tolist(), "quality": self.quality.tolist(),
+                "mismatch": self.mismatch.tolist()}
+
+    @classmethod
+    def fromstate(cls, d):
+        return cls(d["reads"], d["bases"], np.array(d["lengths"], dtype=np.int64),
+                   np.array(d["composition"], dtype=np.int64).reshape(-1, len(BASES)),
+                   np.array(d["quality"], dtype=np.int64).reshape(-1, 3),
+                   np.array(d["mismatch"], dtype=np.int64))
+
+    def summary(self):
+        n = float(max(self.bases, 1))
+        qsum, q20, q30 = self.quality.sum(0) if len(self.quality) else (0, 0, 0)
+        cover = np.maximum(self.composition.sum(1), 1)
+        res = {
+            "reads": self.reads,
+            "bases": self.bases,
+            "mean_length": round(self.bases / float(max(self.reads, 1)), 2),
+            "length_histogram": dict((str(i), int(c)) for i, c in enumerate(self.lengths) if c),
+            "base_composition": dict((b, self.composition[:, i].tolist()) for i, b in enumerate(BASES)),
+            "mean_quality": round(qsum / n, 2),
+            "cycle_quality": np.round(self.quality[:, 0] / cover, 2).tolist(),
+            "q20": round(q20 / n, 4),
+            "q30": round(q30 / n, 4),
+        }
+        if len(self.mismatch):
+            res["barcode_mismatch"] = dict((str(i), int(c))
+                                           for i, c in enumerate(self.mismatch))
+        return res
+
+
+def strided(arr, width):
+    # every width-byte window of arr as a read only view
+    return np.lib.stride_tricks.as_strided(arr, (max(len(arr) - width + 1, 0), width),
+                                           (arr.strides[0],) * 2, writeable=False)
+
+
+def windows(arr, starts, width):
+    # width bytes from every start, the few rows running past the end are read
+    # from a zero padded copy of the tail
+    lim = len(arr) - width
+    far = np.flatnonzero(starts > lim)
+    if not len(far):
+        return strided(arr, width)[starts]
+    lo = int(starts[far].min())
+    tail = strided(np.concatenate([arr[lo:], np.zeros(width, dtype=np.uint8)]), width)
+    if len(far) == len(starts):
+        return tail[starts - lo]
+    rows = strided(arr, width)[np.minimum(starts, lim)]
+    rows[far] = tail[starts[far] - lo]
+    return rows
+
+
+def barcode_matrix(barcodes):
+    bw = max(map(len, barcodes))
+    bmat = np.zeros((len(barcodes), bw), dtype=np.uint8)
+    blen = np.zeros(len(barcodes), dtype=np.int64)
+    for i, b in enumerate(barcodes):
+        bmat[i, :len(b)] = np.frombuffer(b, dtype=np.uint8)
+        blen[i] = len(b)
+    return bmat, blen
+
+
+class QCIndex(object):
+
+    def __init__(self, barcode, barcode_paired=None):
+        # samples and barcodes of a splitter by number, the matches of a block
+        # are turned into arrays of these numbers for read_qc
+        barcode_paired = barcode_paired or {}
+        self.samples = list(dict.fromkeys(list(barcode.values()) + list(barcode_paired.values())))
+        self.sample_no = dict((sn, i) for i, sn in enumerate(self.samples))
+        bc1 = list(barcode)
+        self.bc1_no = dict((b, i) for i, b in enumerate(bc1))
+        self.bc1_sample = np.array([self.sample_no[barcode[b]] for b in bc1], dtype=np.int64)
+        self.bc1 = barcode_matrix(bc1)
+        bc2 = list(dict.fromkeys(b for _, b in barcode_paired))
+        self.bc2_no = dict((b, i) for i, b in enumerate(bc2))
+        self.bc2 = bc2 and barcode_matrix(bc2) or None
+        self.pair_no = dict((k, self.sample_no[sn]) for k, sn in barcode_paired.items())
+
+    @staticmethod
+    def numbers(keys, table):
+        return np.fromiter(map(table.get, keys, repeat(-1, len(keys))), dtype=np.int64, count=len(keys))
+
+
+def read_qc(block, rows, sid, samples, trims=None, bid=None, barcodes=None, offsets=None, mis=0):
+    # rows are record numbers in block, sid their sample numbers in samples and
+    # bid their barcode numbers in a barcode_matrix. Rows are grouped by sample
+    # and every sample is counted with column sums over its rows, N is what the
+    # read lengths cover beyond ACGT
+    if not len(rows):
+        return {}
+    used = np.flatnonzero(np.bincount(sid, minlength=len(samples)))
+    ns = len(used)
+    if ns < len(samples):
+        num = np.zeros(len(samples), dtype=np.int64)
+        num[used] = np.arange(ns)
+        sid = num[sid]
+    arr = np.frombuffer(block.buf, dtype=np.uint8)
+    pos = np.fromiter(block.pos, dtype=np.int64, count=len(block.pos))
+    raw, qual = pos[1::4][rows], pos[3::4][rows]
+    seq, lens = raw, pos[2::4][rows] - 1 - raw
+    if trims is not None:
+        t = np.asarray(trims, dtype=np.int64)[rows]
+        seq, qual, lens = seq + t, qual + t, np.maximum(lens - t, 0)
+    width = max(int(lens.max()), 1)
+    lh = np.bincount(sid * (width + 1) + lens,
+                     minlength=ns * (width + 1)).reshape(ns, width + 1)
+    reads = lh.sum(1)
+    bases = lh.dot(np.arange(width + 1))
+    cover = lh[:, :0:-1].cumsum(1)[:, ::-1]
+    # rows of every sample are padded with blank rows to whole groups of fold
+    # rows, groups are added up in one pass and samples from their groups
+    fold = max(min(QC_FOLD, len(sid) // ns), 1)
+    groups = -(-reads // fold)
+    first = np.cumsum(groups) - groups
+    order = np.argsort(sid.astype(ns < 1 << 16 and np.uint16 or np.int64), kind="stable")
+    src = np.full(int(groups.sum()) * fold, len(sid), dtype=np.int64)
+    src[np.repeat(first * fold - np.cumsum(reads) + reads, reads) + np.arange(len(sid))] = order
+    seq, qual = np.append(seq, len(arr))[src], np.append(qual, len(arr))[src]
+    short = None
+    if lens.min() < width:
+        ltype = width < 1 << 16 and np.uint16 or np.int64
+        short = np.append(lens, 0)[src].astype(ltype)
+        cols = np.arange(width, dtype=ltype)
+    chunk = QC_ROWS // fold * fold
+    gsum = np.empty((len(src) // fold, 6, width), dtype=np.uint8)
+    gq = np.empty((len(src) // fold, width), dtype=np.uint16)
+    fbuf = np.empty((min(chunk, len(src)), 6, width), dtype=np.bool_)
+    for c in range(0, len(src), chunk):
+        n = min(chunk, len(src) - c)
+        s = windows(arr, seq[c:c+n], width)
+        q = windows(arr, qual[c:c+n], width)
+        s &= 0xDF
+        if short is not None:
+            keep = np.less(cols, short[c:c+n, None])
+            s *= keep
+            q *= keep
+        f = fbuf[:n]
+        for j, base in enumerate(bytearray(b"ACGT")):
+            np.equal(s, base, out=f[:, j])
+        np.greater_equal(q, 53, out=f[:, 4])
+        np.greater_equal(q, 63, out=f[:, 5])
+        g = slice(c // fold, (c + n) // fold)
+        f.view(np.uint8).reshape(-1, fold, 6, width).sum(1, dtype=np.uint8, out=gsum[g])
+        q.reshape(-1, fold, width).sum(1, dtype=np.uint16, out=gq[g])
+    flags = np.add.reduceat(gsum, first, axis=0, dtype=np.int64)
+    qsum = np.add.reduceat(gq, first, axis=0, dtype=np.int64)
+    comp = np.empty((ns, width, len(BASES)), dtype=np.int64)
+    comp[..., :4] = flags[:, :4].transpose(0, 2, 1)
+    comp[..., 4] = cover - flags[:, :4].sum(1)
+    quality = np.stack([qsum - 33 * cover, flags[:, 4], flags[:, 5]], 2)
+    mh = None
+    if bid is not None:
+        bmat, blen = barcodes
+        bw = bmat.shape[1]
+        start = raw
+        if offsets is not None:
+            start = start + np.asarray(offsets, dtype=np.int64)
+        dist = windows(arr, start, bw) != bmat[bid]
+        if blen.min() < bw:
+            dist &= np.arange(bw) < blen[bid][:, None]
+        dist = dist.sum(1)
+        np.minimum(dist, mis, out=dist)
+        mh = np.bincount(sid * (mis + 1) + dist,
+                         minlength=ns * (mis + 1)).reshape(ns, mis + 1)
+    res = {}
+    for i, k in enumerate(used):
+        res[samples[k]] = ReadQC(int(reads[i]), int(bases[i]), lh[i], comp[i], quality[i],
+                                 None if mh is None else mh[i])
+    return res
+
+
+def merge_qc(total, part):
+    for sn, qc in part.items():
+        if sn in total:
+            total[sn].add(qc)
+        else:
+            total[sn] = qc
+
+
+def write_qc(path, qcs, samples=None):
+    res = {}
+    for sn in samples or sorted(set(k for qc in qcs for k in qc)):
+        res[sn] = dict(("R%d" % (n + 1), qc.get(sn, ReadQC()).summary())
+                       for n, qc in enumerate(qcs))
+    with open(path, "w") as fo:
+        json.dump(res, fo, indent=2, sort_keys=True)
+    logging.getLogger().info("per sample qc written to %s", path)
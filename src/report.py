@@ -0,0 +1,139 @@
+from .utils import *
+from .version import __version__
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+def clock():
+    return time.time(), process_time()
+
+
+def elapsed(start, stats, name):
+    wall, cpu = start
+    st = stats.setdefault(name, [0.0, 0.0, 0])
+    st[0] += time.time() - wall
+    st[1] += process_time() - cpu
+    st[2] += 1
+    return clock()
+
+
+def merge_stages(stages, stats):
+    for name, (wall, cpu, calls) in stats.items():
+        st = stages.setdefault(name, [0.0, 0.0, 0])
+        st[0] += wall
+        st[1] += cpu
+        st[2] += calls
+
+
+def proc_file_pos(pid, path):
+    path = os.path.realpath(path)
+    fddir = "/proc/%d/fd" % pid
+    try:
+        for fd in os.listdir(fddir):
+            if os.path.realpath(os.path.join(fddir, fd)) == path:
+                with open("/proc/%d/fdinfo/%s" % (pid, fd)) as fi:
+                    for line in fi:
+                        if line.startswith("pos:"):
+                            return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class RunReport(object):
+
+    def __init__(self, enabled=False, interval=30):
+        self.enabled = enabled
+        self.interval = interval
+        self.start = clock()
+        self.stages = {}
+        self.reads = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.inputs = []
+        self.sources = []
+        self.total_reads = None
+        self.hopped = None
+        self.input_samples = None
+        self.last = self.start[0]
+        self.last_reads = 0
+
+    def watch(self, path, proc=None):
+        self.inputs.append(path)
+        self.sources.append((path, proc))
+
+    def fraction(self):
+        if self.total_reads:
+            return self.reads / float(self.total_reads)
+        path, proc = self.sources and self.sources[0] or (None, None)
+        if path is None or is_stream(path):
+            return None
+        size = os.path.getsize(path)
+        if proc is not None:
+            pos = proc_file_pos(proc.pid, path)
+        elif not path.endswith(".gz"):
+            pos = self.bytes_in // len(self.sources)
+        else:
+            pos = None
+        return pos is not None and size and min(pos / float(size), 1.0) or None
+
+    def update(self, reads, stats=None, bytes_out=0):
+        self.reads += reads
+        self.bytes_out += bytes_out
+        if stats:
+            self.bytes_in += stats.pop("bytes_in", 0)
+            merge_stages(self.stages, stats)
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        rate = (self.reads - self.last_reads) / (now - self.last)
+        frac = self.fraction()
+        if frac:
+            eta = (now - self.start[0]) * (1 - frac) / frac
+            self.logs.info("processed %d reads, %.0f reads/s, %.1f%%, ETA %s",
+                           self.reads, rate, frac * 100, time.strftime("%H:%M:%S", time.gmtime(eta)))
+        else:
+            self.logs.info("processed %d reads, %.0f reads/s",
+                           self.reads, rate)
+        self.last, self.last_reads = now, self.reads
+
+    def summary(self, sms=None):
+        wall = time.time() - self.start[0]
+        t = os.times()
+        res = {
+            "version": __version__,
+            "command": " ".join(sys.argv),
+            "inputs": self.inputs,
+            "wall": round(wall, 3),
+            "cpu": round(process_time() - self.start[1] + t[2] + t[3], 3),
+            "reads": self.reads,
+            "reads_per_sec": round(self.reads / wall, 1) if wall else 0,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "mb_per_sec": round(self.bytes_in / 1048576.0 / wall, 2) if wall else 0,
+            "stages": dict((k, {"wall": round(v[0], 3), "cpu": round(v[1], 3), "calls": v[2]})
+                           for k, v in self.stages.items()),
+        }
+        if sms is not None:
+            res["samples"] = dict(sms)
+        if self.hopped is not None:
+            res["hopped"] = self.hopped
+        if self.input_samples is not None:
+            res["input_samples"] = self.input_samples
+        return res
+
+    def log_stages(self):
+        for name, (wall, cpu, calls) in sorted(self.stages.items()):
+            self.logs.info("stage %s: wall %.2fs, cpu %.2fs, %d calls",
+                           name, wall, cpu, calls)
+
+    def dump(self, path, sms=None):
+        with open(path, "w") as fo:
+            json.dump(self.summary(sms), fo, indent=2, sort_keys=True)
+
+    @property
+    def logs(self):
+        return logging.getLogger()
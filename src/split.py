@@ -0,0 +1,722 @@
+import re
+import mmap
+
+from collections import deque
+from contextlib import closing
+
+from .zran import *
+from .fastq import *
+from .qc import *
+from .report import *
+from .checkpoint import *
+from .barcode import *
+
+HEADER_CACHE_SIZE = 1 << 20
+NAME_END = re.compile(br"\s")
+
+_splitter = None
+_shard = None
+_gzip_index = {}
+_mmaps = {}
+
+
+class FastqSplitter(object):
+
+    def __init__(self, barcode, barcode_paired=None, mis=0, drup=False, engine="python", profile=False, cache=None, source="sequence", window=None, qc=False, umi=None):
+        self.barcode = barcode
+        self.mis = mis
+        self.profile = profile
+        self.qc = qc and QCIndex(barcode, barcode_paired) or None
+        self.source = source
+        self.window = window
+        self.umi = umi
+        self.drup = drup
+        self.tag_width = None
+        self.header_hits = {}
+        self.header_miss = set()
+        self.index_hits = ({}, {})
+        self.pairs = {}
+        for (bc1, bc2), sn in (barcode_paired or {}).items():
+            self.pairs.setdefault(bc1, {})[bc2] = sn
+        self.bc_index = barcode_index(barcode, mis, engine, cache)
+        self.bc2_index = None
+        self.drup_pos = dict.fromkeys(barcode, 0)
+        if barcode_paired:
+            bc2s = list(dict.fromkeys(bc2 for _, bc2 in barcode_paired))
+            self.bc2_index = barcode_index(bc2s, mis, engine, cache)
+            self.drup_pos.update(dict.fromkeys(bc2s, 0))
+        if drup:
+            for bc in self.drup_pos:
+                self.drup_pos[bc] = len(bc)
+
+    def split(self, batch):
+        stats = {}
+        if isinstance(batch, (IndexedBatch, MmapBatch)):
+            t = self.profile and clock()
+            batch = batch.load()
+            if t:
+                elapsed(t, stats, "read")
+                stats["bytes_in"] = sum(b.nbytes for b in batch if b)
+        block1, block2 = batch
+        if self.source == "header":
+            return self.split_header(block1, block2, stats)
+        if block2 is None:
+            return self.split_single(block1, stats)
+        return self.split_paired(block1, block2, stats)
+
+    def split_single(self, block, stats):
+        out = {}
+        sms = Counter()
+        t = self.profile and clock()
+        matches, trims, ends = self.match(self.bc_index, block)
+        if t:
+            t = elapsed(t, stats, "match")
+        buf, pos = block.buf, block.pos
+        barcode = self.barcode
+        cuts = self.umi_ends(matches, ends)
+        for r, b, dp, e in zip(range(0, len(pos) - 1, 4), matches, trims, cuts):
+            if b is None:
+                continue
+            sn = barcode[b]
+            if sn not in out:
+                out[sn] = []
+            if e is not None:
+                out[sn].extend(self.cut_umi(buf, pos, r, dp, e)[1])
+            elif dp:
+                out[sn].extend((buf[pos[r]:pos[r+1]], buf[pos[r+1]+dp:pos[r+3]],
+                                buf[pos[r+3]+dp:pos[r+4]]))
+            else:
+                out[sn].append(buf[pos[r]:pos[r+4]])
+            sms[sn] += 1
+        out = self.join(out)
+        if t:
+            t = elapsed(t, stats, "trim")
+        if self.qc:
+            qc = self.qc
+            bid = qc.numbers(matches, qc.bc1_no)
+            rows = np.flatnonzero(bid >= 0)
+            bid = bid[rows]
+            stats["qcs"] = (self.read_qc(block, rows, qc.bc1_sample[bid], bid, qc.bc1,
+                                        matches, self.qc_trims(trims, cuts), ends), {})
+            if t:
+                elapsed(t, stats, "qc")
+        return len(block), sms, out, {}, stats
+
+    def split_paired(self, block1, block2, stats):
+        out1, out2 = {}, {}
+        sms = Counter()
+        t = self.profile and clock()
+        matches, trims, ends = self.match(self.bc_index, block1)
+        matches2, trims2, ends2 = self.match(self.bc2_index, block2)
+        if t:
+            t = elapsed(t, stats, "match")
+        buf1, pos1 = block1.buf, block1.pos
+        buf2, pos2 = block2.buf, block2.pos
+        pairs = self.pairs
+        hopped = Counter()
+        cuts = self.umi_ends(matches, ends)
+        for r, b, m2, dp, dp2, e in zip(range(0, len(pos1) - 1, 4), matches, matches2, trims, trims2, cuts):
+            if b is None or m2 is None:
+                continue
+            sn = pairs[b].get(m2)
+            if sn is None:
+                hopped[b, m2] += 1
+                continue
+            if e is not None:
+                umi, rec = self.cut_umi(buf1, pos1, r, dp, e)
+                out1.setdefault(sn, []).extend(rec)
+                out2.setdefault(sn, []).extend(self.tag_umi(buf2, pos2, r, dp2, umi))
+            else:
+                out1.setdefault(sn, []).extend(self.trim(buf1, pos1, r, dp))
+                out2.setdefault(sn, []).extend(self.trim(buf2, pos2, r, dp2))
+            sms[sn] += 1
+        out1, out2 = self.join(out1), self.join(out2)
+        if t:
+            t = elapsed(t, stats, "trim")
+        stats["hopped"] = hopped
+        if self.qc:
+            qc = self.qc
+            sid = qc.numbers(list(zip(matches, matches2)), qc.pair_no)
+            rows = np.flatnonzero(sid >= 0)
+            sid = sid[rows]
+            bid1 = qc.numbers(matches, qc.bc1_no)[rows]
+            bid2 = qc.numbers(matches2, qc.bc2_no)[rows]
+            stats["qcs"] = (self.read_qc(block1, rows, sid, bid1, qc.bc1, matches, self.qc_trims(trims, cuts), ends),
+                           self.read_qc(block2, rows, sid, bid2, qc.bc2, matches2, trims2, ends2))
+            if t:
+                elapsed(t, stats, "qc")
+        return len(block1), sms, out1, out2, stats
+
+    def match(self, index, block):
+        if self.window is None:
+            matches = index.match_block(block)
+            drup_pos = self.drup_pos
+            return matches, [b is not None and drup_pos[b] for b in matches], None
+        hits = index.match_window(block, *self.window)
+        matches = [h and h[0] for h in hits]
+        ends = [h and h[1] for h in hits]
+        if not self.drup:
+            return matches, [0] * len(hits), ends
+        return matches, ends, ends
+
+    def umi_ends(self, matches, ends):
+        # umi offsets count from the barcode end, with or without -d
+        if self.umi is None:
+            return repeat(None)
+        return ends or [b and len(b) for b in matches]
+
+    def cut_umi(self, buf, pos, r, dp, end):
+        s, q = pos[r+1], pos[r+3]
+        u0, u1 = end + self.umi[0], end + self.umi[0] + self.umi[1]
+        n = pos[r+2] - 1 - s
+        if u1 > n:
+            u0, u1 = min(u0, n), n
+        umi = buf[s+u0:s+u1]
+        h = name_end(buf, pos[r], s)
+        return umi, (buf[pos[r]:h], b"_", umi, buf[h:s], buf[s+dp:s+u0], buf[s+u1:q],
+                     buf[q+dp:q+u0], buf[q+u1:pos[r+4]])
+
+    @staticmethod
+    def tag_umi(buf, pos, r, dp, umi):
+        h = name_end(buf, pos[r], pos[r+1])
+        return (buf[pos[r]:h], b"_", umi, buf[h:pos[r+1]], buf[pos[r+1]+dp:pos[r+3]],
+                buf[pos[r+3]+dp:pos[r+4]])
+
+    def qc_trims(self, trims, cuts):
+        # a umi right after a trimmed barcode is trimmed with it, otherwise
+        # R1 qc still counts the umi bases
+        start, num = self.umi or (1, 0)
+        if start:
+            return trims
+        return [dp and e + num for dp, e in zip(trims, cuts)]
+
+    def read_qc(self, block, rows, sid, bid, barcodes, matches, trims, ends):
+        offsets = None
+        if ends is not None:
+            # unmatched records of a window have no trim or end
+            trims = [dp or 0 for dp in trims]
+            offsets = [ends[i] - len(matches[i]) for i in rows]
+        return read_qc(block, rows, sid, self.qc.samples, trims, bid, barcodes, offsets, self.mis)
+
+    def split_header(self, block1, block2, stats):
+        out1, out2 = {}, {}
+        sms = Counter()
+        t = self.profile and clock()
+        matches = self.match_header(block1)
+        if t:
+            t = elapsed(t, stats, "match")
+        buf1, pos1 = block1.buf, block1.pos
+        buf2, pos2 = block2 is not None and (block2.buf, block2.pos) or (None, None)
+        hopped = Counter()
+        for r, sn in zip(range(0, len(pos1) - 1, 4), matches):
+            if sn is None:
+                continue
+            if isinstance(sn, tuple):
+                hopped[sn] += 1
+                continue
+            if sn not in out1:
+                out1[sn] = []
+                out2[sn] = []
+            out1[sn].append(buf1[pos1[r]:pos1[r+4]])
+            if buf2 is not None:
+                out2[sn].append(buf2[pos2[r]:pos2[r+4]])
+            sms[sn] += 1
+        out1 = self.join(out1)
+        out2 = buf2 is not None and self.join(out2) or {}
+        if t:
+            t = elapsed(t, stats, "trim")
+        stats["hopped"] = hopped
+        if self.qc:
+            samples = self.qc.samples
+            sid = self.qc.numbers(matches, self.qc.sample_no)
+            rows = np.flatnonzero(sid >= 0)
+            sid = sid[rows]
+            stats["qcs"] = (read_qc(block1, rows, sid, samples),
+                           buf2 is not None and read_qc(block2, rows, sid, samples) or {})
+            if t:
+                elapsed(t, stats, "qc")
+        return len(block1), sms, out1, out2, stats
+
+    def match_header(self, block):
+        # cut a fixed width tail from ':' before the index to the newline,
+        # tails of another shape are parsed again from the header
+        buf, pos = block.buf, block.pos
+        ends = pos[1::4]
+        if self.tag_width is None:
+            self.tag_width = pos[1] - buf.rfind(b":", pos[0], pos[1])
+        w = self.tag_width
+        keys = [buf[e-w:e] for e in ends]
+        hits = self.header_hits
+        if len(hits) > HEADER_CACHE_SIZE:
+            hits.clear()
+            self.header_miss.clear()
+            for h in self.index_hits:
+                h.clear()
+        new = list(set(keys).difference(hits))
+        if new:
+            tags = []
+            for k in new:
+                if k[:1] == b":" and k.count(b":") == 1:
+                    tags.append(k[1:].rstrip())
+                else:
+                    tags.append(None)
+                    self.header_miss.add(k)
+            hits.update(zip(new, self.match_tags(tags)))
+        res = list(map(hits.__getitem__, keys))
+        if self.header_miss and not self.header_miss.isdisjoint(keys):
+            idx = [i for i, k in enumerate(keys) if k in self.header_miss]
+            tags = [buf[pos[4*i]:ends[i]].rstrip().rpartition(b":")[2] for i in idx]
+            for i, b in zip(idx, self.match_tags(tags)):
+                res[i] = b
+        return res
+
+    def match_tags(self, tags):
+        pairs = [t is not None and t.partition(b"+")[::2] or (b"", b"")
+                 for t in tags]
+        res = self.lookup([i7 for i7, _ in pairs],
+                          self.bc_index, self.index_hits[0])
+        if self.bc2_index is None:
+            return [b is not None and self.barcode[b] or None for b in res]
+        res2 = self.lookup([i5 for _, i5 in pairs],
+                           self.bc2_index, self.index_hits[1])
+        return [b is not None and b2 is not None and (self.pairs[b].get(b2) or (b, b2)) or None
+                for b, b2 in zip(res, res2)]
+
+    @staticmethod
+    def lookup(seqs, index, hits):
+        # distinct i7 and i5 values are far fewer than their combinations
+        new = list(set(seqs).difference(hits))
+        if new:
+            hits.update(zip(new, index.match_many(new)))
+        return [hits[s] for s in seqs]
+
+    @staticmethod
+    def trim(buf, pos, r, dp):
+        if not dp:
+            return (buf[pos[r]:pos[r+4]],)
+        return (buf[pos[r]:pos[r+1]], buf[pos[r+1]+dp:pos[r+3]], buf[pos[r+3]+dp:pos[r+4]])
+
+    @staticmethod
+    def join(out):
+        return dict((sn, b"".join(lines)) for sn, lines in out.items())
+
+
+def name_end(buf, start, end):
+    h = buf.find(b" ", start, end)
+    if h < 0 or buf.find(b"\t", start, h) >= 0:
+        h = NAME_END.search(buf, start, end).start()
+    return h
+
+
+class IndexedBatch(object):
+
+    def __init__(self, fq1, fq2, start, num):
+        self.fq1 = fq1
+        self.fq2 = fq2
+        self.start = start
+        self.num = num
+
+    def load(self):
+        block1 = read_index_block(self.fq1, self.start, self.num)
+        block2 = None
+        if self.fq2:
+            block2 = read_index_block(self.fq2, self.start, self.num)
+            check_mates(block1, block2, self.fq1, self.fq2, self.start)
+        return block1, block2
+
+
+def load_index(fq):
+    if fq not in _gzip_index:
+        _gzip_index[fq] = GzipIndex(fq).load()
+    return _gzip_index[fq]
+
+
+def read_index_block(fq, start, num):
+    gzi = load_index(fq)
+    i = gzi.point(start)
+    with closing(gzi.open(i)) as fh:
+        parser = FastqParser(fh, fq)
+        skip = start - gzi.points[i][5]
+        if skip:
+            parser.read(skip)
+        return parser.read(num)
+
+
+def index_batches(fq1, fq2=None, skip=0):
+    if not fq1.endswith(".gz") or fq2 and not fq2.endswith(".gz"):
+        return None
+    gzi = GzipIndex.fromfile(fq1)
+    if gzi is None:
+        return None
+    if fq2:
+        gzi2 = GzipIndex.fromfile(fq2)
+        if gzi2 is None:
+            return None
+        if gzi.nrec != gzi2.nrec:
+            raise IOError("paired fastq record number not equal: %s(%d), %s(%d)" % (
+                fq1, gzi.nrec, fq2, gzi2.nrec))
+    return [IndexedBatch(fq1, fq2, max(s, skip), s + n - max(s, skip))
+            for s, n in gzi.slices() if s + n > skip]
+
+
+class MmapBatch(object):
+
+    def __init__(self, fq1, fq2, span1, span2=None):
+        self.fq1 = fq1
+        self.fq2 = fq2
+        self.span1 = span1
+        self.span2 = span2
+
+    def load(self):
+        block1 = read_mmap_block(self.fq1, *self.span1)
+        block2 = None
+        if self.fq2:
+            block2 = read_mmap_block(self.fq2, *self.span2)
+            check_mates(block1, block2, self.fq1, self.fq2)
+        return block1, block2
+
+
+def map_file(fq):
+    if fq not in _mmaps:
+        with open(fq, "rb") as fi:
+            _mmaps[fq] = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+    return _mmaps[fq]
+
+
+def read_mmap_block(fq, start, end):
+    # records are parsed in place, sample output is sliced from the mapping
+    mm = map_file(fq)
+    start, end = record_start(mm, start), record_start(mm, end)
+    parser = FastqParser(None, fq)
+    pos = parser.parse(mm, start, end=end)
+    if pos[-1] != end:
+        raise IOError("truncated fastq record (byte %d) in %s" % (pos[-1], fq))
+    return FastqBlock(mm, pos)
+
+
+def skip_records(buf, start, num, span=BLOCK_SIZE):
+    lines = num * 4
+    while lines:
+        chunk = buf[start:start+span]
+        if not chunk:
+            break
+        n = chunk.count(b"\n")
+        if n < lines:
+            lines -= n
+            start += len(chunk)
+            continue
+        start += len(chunk) - len(chunk.split(b"\n", lines)[-1])
+        break
+    return start
+
+
+def mmap_batches(fq1, fq2=None, threads=1, span=BLOCK_SIZE, skip=0):
+    fqs = [f for f in (fq1, fq2) if f]
+    if any(f.endswith(".gz") or not os.path.isfile(f) or not os.path.getsize(f) for f in fqs):
+        return None
+    for f in fqs:
+        with open(f, "rb") as fi:
+            fi.seek(-1, os.SEEK_END)
+            if fi.read(1) != b"\n":
+                return None
+    size1 = os.path.getsize(fq1)
+    start1 = skip and skip_records(map_file(fq1), 0, skip) or 0
+    span = max(min(span, (size1 - start1) // (threads * 4)), 1 << 20)
+    if not fq2:
+        return [MmapBatch(fq1, None, (s, min(s + span, size1))) for s in range(start1, size1, span)]
+    # mates are aligned by record count, so the cuts in fq2 follow fq1
+    mm1, mm2 = map_file(fq1), map_file(fq2)
+    cuts = sorted(set(record_start(mm1, s)
+                      for s in range(start1, size1, span)) | set([size1]))
+    size2 = len(mm2)
+    batches = []
+    s2 = skip and skip_records(mm2, 0, skip) or 0
+    for s1, e1 in zip(cuts[:-1], cuts[1:]):
+        e2 = e1 < size1 and skip_records(mm2, s2, mm1[s1:e1].count(b"\n") // 4,
+                                          max(e1 - s1, 1 << 16)) or size2
+        batches.append(MmapBatch(fq1, fq2, (s1, e1), (s2, e2)))
+        s2 = e2
+    return batches
+
+
+def skip_input(parser, num):
+    # records written before a resume, plain files are skipped by offset
+    if not parser.name.endswith(".gz"):
+        offset = skip_records(map_file(parser.name), 0, num)
+        parser.fh.seek(offset)
+        parser.nrec, parser.offset = num, offset
+        return
+    while num:
+        block = parser.read(min(num, 1 << 16))
+        if block is None:
+            raise IOError("%s has fewer records than the checkpoint" % parser.name)
+        num -= len(block)
+
+
+def read_batches(fq1, fq2=None, report=None, skip=0):
+    profile = report is not None and report.enabled
+    z1, z2 = Zopen(fq1, gzip=True), Zopen(fq2, gzip=True)
+    with z1 as fi1, z2 as fi2:
+        if report is not None:
+            report.watch(fq1, z1.proc)
+            if fq2:
+                report.watch(fq2, z2.proc)
+        p1 = FastqParser(fi1, fq1)
+        p2 = fi2 and FastqParser(fi2, fq2)
+        for p in (p1, p2):
+            if p and skip:
+                skip_input(p, skip)
+        if not fi2:
+            while True:
+                t = profile and clock()
+                block1 = p1.read()
+                if block1 is None:
+                    break
+                if t:
+                    elapsed(t, report.stages, "read")
+                    report.bytes_in += block1.nbytes
+                yield block1, None
+            return
+        for block1, block2 in read_mates(p1, p2, report):
+            yield block1, block2
+
+
+def read_mates(p1, p2, report=None):
+    profile = report is not None and report.enabled
+    pool = ThreadPool(2)
+    try:
+        t = profile and clock()
+        block1 = p1.read()
+        num = block1 and len(block1) or 1
+        block2 = p2.read(num)
+        nrec = 0
+        while block1 is not None or block2 is not None:
+            if block1 is None:
+                raise IOError("paired fastq %s has more records than %s (record %d)" % (
+                    p2.name, p1.name, nrec + 1))
+            check_mates(block1, block2, p1.name, p2.name, nrec)
+            nrec += len(block1)
+            r1 = pool.apply_async(p1.read, (num,))
+            r2 = pool.apply_async(p2.read, (num,))
+            if t:
+                elapsed(t, report.stages, "read")
+                report.bytes_in += block1.nbytes + block2.nbytes
+            yield block1, block2
+            t = profile and clock()
+            block1, block2 = r1.get(), r2.get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class Shard(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class ShardWriter(object):
+
+    def __init__(self, tmpdir, gz=False):
+        self.tmpdir = tmpdir
+        self.gz = gz
+        self.num = 0
+
+    def write(self, out):
+        res = {}
+        for sn, data in out.items():
+            self.num += 1
+            path = os.path.join(self.tmpdir, "%d.%d" % (os.getpid(), self.num))
+            with open(path, "wb") as fo:
+                if self.gz:
+                    for i in range(0, len(data), BGZF_BLOCK_SIZE):
+                        fo.write(bgzf_block(data[i:i+BGZF_BLOCK_SIZE]))
+                else:
+                    fo.write(data)
+            res[sn] = Shard(path, len(data))
+        return res
+
+    def dump(self, res):
+        total, counts, out1, out2, stats = res
+        return total, counts, self.write(out1), self.write(out2), stats
+
+
+class ShardFile(object):
+
+    def __init__(self, name, mode="wb"):
+        self.name = name
+        open(name, mode).close()
+
+    def write(self, shard):
+        append_file(shard.path, self.name)
+        os.remove(shard.path)
+
+
+class ShardOutput(object):
+
+    def __init__(self, gz=False, mode="wb", **outfiles):
+        self.gz = gz
+        self.mode = mode
+        self.info = outfiles
+        self.handler = {}
+
+    def __enter__(self):
+        for sn, f in self.info.items():
+            self.handler[sn] = ShardFile(f, self.mode)
+        return self.handler
+
+    def sync(self):
+        return dict((f, os.path.getsize(f)) for f in self.info.values())
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.gz and exc_type is None:
+            for f in self.info.values():
+                with open(f, "ab") as fo:
+                    fo.write(BGZF_EOF)
+
+
+def load_inputs(input1, input2=None, manifest=None):
+    input1, input2 = input1 or [], input2 or []
+    if input2 and len(input2) != len(input1):
+        raise IOError("%d -I/--Input files given for %d -i/--input files" %
+                      (len(input2), len(input1)))
+    inputs = list(zip(input1, input2 or [None] * len(input1)))
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest) as fi:
+            for line in fi:
+                line = line.split()
+                if not line or line[0].startswith("#"):
+                    continue
+                if len(line) > 2:
+                    raise IOError("illegal manifest line in %s: %s" % (manifest, " ".join(line)))
+                fqs = [f == "-" and f or os.path.join(base, f) for f in line]
+                inputs.append((fqs[0], len(fqs) > 1 and fqs[1] or None))
+    if not inputs:
+        raise IOError("no input fastq, use -i/--input or --manifest")
+    if len(set(fq2 is None for _, fq2 in inputs)) > 1:
+        raise IOError("single and paired inputs can not be mixed")
+    fqs = sum(map(list, inputs), [])
+    if fqs.count("-") > 1:
+        raise IOError("stdin '-' can only be read once")
+    for fq in fqs:
+        if fq is not None and fq != "-" and not os.path.exists(fq):
+            raise IOError("No such file or directory: %s" % fq)
+    return inputs
+
+
+def input_sources(inputs, threads=1, report=None, skips=None):
+    # skips: records already written per input, None for finished inputs
+    sources = []
+    for (fq1, fq2), skip in zip(inputs, skips or [0] * len(inputs)):
+        if skip is None:
+            sources.append([])
+            continue
+        stream = is_stream(fq1) or fq2 and is_stream(fq2)
+        batches = None
+        if not stream and (threads > 1 or skip):
+            batches = index_batches(fq1, fq2, skip)
+            if batches is not None:
+                logging.getLogger().info("read %s in %d slices by gzip index", fq1, len(batches))
+        if batches is None and threads > 1 and not stream:
+            batches = mmap_batches(fq1, fq2, threads, skip=skip)
+            if batches is not None:
+                logging.getLogger().info("read %s in %d mmap slices", fq1, len(batches))
+        if batches is not None and report is not None:
+            report.inputs.extend(i for i in (fq1, fq2) if i)
+        sources.append(batches if batches is not None else
+                       read_batches(fq1, fq2, report=report, skip=skip))
+    return sources
+
+
+def interleave(sources, jobs=1):
+    # pull batches round robin from at most jobs inputs, None ends an input
+    sources = enumerate(sources)
+    active = deque()
+    for n, src in sources:
+        active.append((n, iter(src)))
+        if len(active) >= jobs:
+            break
+    while active:
+        n, it = active.popleft()
+        batch = next(it, None)
+        if batch is None:
+            nxt = next(sources, None)
+            if nxt is not None:
+                active.append((nxt[0], iter(nxt[1])))
+        else:
+            active.append((n, it))
+        yield n, batch
+
+
+def _init_worker(splitter, shard=None):
+    global _splitter, _shard
+    _splitter = splitter
+    _shard = shard
+
+
+def _split_batch(batch):
+    res = _splitter.split(batch)
+    if _shard is not None:
+        return _shard.dump(res)
+    return res
+
+
+def split_inputs(splitter, sources, threads=1, shard=None, jobs=1):
+    items = interleave(sources, threads > 1 and jobs or 1)
+    if threads <= 1:
+        for n, batch in items:
+            yield n, batch is not None and splitter.split(batch) or None
+        return
+    pool = mp.Pool(threads, initializer=_init_worker,
+                   initargs=(splitter, shard))
+    pending = deque()
+    try:
+        for n, batch in items:
+            pending.append((n, batch is not None and pool.apply_async(
+                _split_batch, (batch,)) or None))
+            while len(pending) >= threads * 2 or pending and pending[0][1] is None:
+                n, res = pending.popleft()
+                yield n, res is not None and res.get() or None
+        while pending:
+            n, res = pending.popleft()
+            yield n, res is not None and res.get() or None
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def write_hopping(path, hopped, pairs, total):
+    by1, by2 = defaultdict(set), defaultdict(set)
+    for (bc1, bc2), sn in pairs.items():
+        by1[bc1].add(sn)
+        by2[bc2].add(sn)
+    num = sum(hopped.values())
+    with open(path, "w") as fo:
+        fo.write("barcode1\tbarcode2\treads\tpercent\tsamples1\tsamples2\n")
+        # ties in the same order on python 2 and 3
+        for (bc1, bc2), n in sorted(hopped.items(), key=lambda x: (-x[1], x[0])):
+            fo.write("%s\t%s\t%d\t%.4f\t%s\t%s\n" % (bc1.decode(), bc2.decode(), n, n * 100.0 / total,
+                                                  ",".join(sorted(by1[bc1])), ",".join(sorted(by2[bc2]))))
+    logging.getLogger().info("%d reads (%.2f%%) have valid but unassigned barcode pairs (index hopping), see %s",
+                             num, total and num * 100.0 / total or 0, path)
+
+
+def write_input_summary(path, inputs, by_input, samples):
+    with open(path, "w") as fo:
+        fo.write("sample\t%s\n" % "\t".join("+".join(i for i in fqs if i) for fqs in inputs))
+        for sn in list(samples) + ["Unknow"]:
+            fo.write("%s\t%s\n" % (sn, "\t".join(str(c[sn]) for c in by_input)))
+        fo.write("Total\t%s\n" % "\t".join(str(sum(c.values())) for c in by_input))
+    for fqs, c in zip(inputs, by_input):
+        logging.getLogger().info("%s: %d reads", "+".join(i for i in fqs if i), sum(c.values()))
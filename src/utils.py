@@ -1,10 +1,15 @@
+import io
 import os
 import sys
+import zlib
 import json
 import gzip
 import time
 import math
 import shutil
+import stat
+import struct
+import threading
 import fnmatch
 import logging
 import argparse
@@ -12,8 +17,13 @@ import subprocess
 
 import multiprocessing as mp
 
-from random import uniform
-from collections import defaultdict, Counter
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from collections import defaultdict, Counter, OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
 from .version import __version__
 
@@ -21,25 +31,489 @@ PY3 = sys.version[0] == "3"
 
 ambiguous_dna_letters = "GATCRYWSMKHBVDN"
 
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def bgzf_block(data, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255,
+                         6, 66, 67, 2, len(cdata) + 25)
+    tail = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                       len(data) & 0xffffffff)
+    return header + cdata + tail
+
+
+def append_file(src, dst):
+    # copy in the kernel, copy_file_range refuses O_APPEND so seek to the end
+    fi = os.open(src, os.O_RDONLY)
+    fo = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        size = os.fstat(fi).st_size
+        start = os.lseek(fo, 0, os.SEEK_END)
+        pos = 0
+        for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if copy is None:
+                continue
+            os.lseek(fo, start + pos, os.SEEK_SET)
+            try:
+                while pos < size:
+                    if copy is os.sendfile:
+                        n = copy(fo, fi, pos, size - pos)
+                    else:
+                        n = copy(fi, fo, size - pos, pos, start + pos)
+                    if not n:
+                        break
+                    pos += n
+            except OSError:
+                continue
+            if pos >= size:
+                return
+        os.lseek(fi, pos, os.SEEK_SET)
+        os.lseek(fo, start + pos, os.SEEK_SET)
+        with io.open(fi, "rb", closefd=False) as r, io.open(fo, "wb", closefd=False) as w:
+            shutil.copyfileobj(r, w, 1 << 20)
+    finally:
+        os.close(fi)
+        os.close(fo)
+
+
+class BgzfWriter(object):
+
+    def __init__(self, name, mode="wb", pool=None, level=6, queue=8):
+        self.name = name
+        self.handler = open(name, mode)
+        self.pool = pool
+        self.level = level
+        self.queue = queue
+        self.buffer = []
+        self.size = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= BGZF_BLOCK_SIZE:
+            self._submit(b"".join(self.buffer))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _submit(self, data, final=False):
+        full = len(data) - len(data) % BGZF_BLOCK_SIZE
+        if final:
+            full = len(data)
+        for i in range(0, full, BGZF_BLOCK_SIZE):
+            block = data[i:i+BGZF_BLOCK_SIZE]
+            if self.pool is None:
+                self.handler.write(bgzf_block(block, self.level))
+            else:
+                self.pending.append(self.pool.apply_async(
+                    bgzf_block, (block, self.level)))
+        rest = data[full:]
+        self.buffer = rest and [rest] or []
+        self.size = len(rest)
+        self._drain(final)
+
+    def _drain(self, wait=False):
+        while self.pending:
+            if not (wait or len(self.pending) > self.queue or self.pending[0].ready()):
+                break
+            self.handler.write(self.pending.popleft().get())
+
+    def flush(self):
+        if self.buffer:
+            self._submit(b"".join(self.buffer), final=True)
+        self._drain(wait=True)
+        self.handler.flush()
+
+    def close(self, eof=True):
+        if self.handler.closed:
+            return
+        self.flush()
+        if eof:
+            self.handler.write(BGZF_EOF)
+        self.handler.close()
+
+
+class PooledHandle(object):
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.buffer = []
+        self.size = 0
+        self.opened = False
+        self.handler = None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        self.owner.buffered += len(data)
+        if self.size >= self.owner.buffer_size:
+            self.flush()
+        elif self.owner.buffered > self.owner.max_buffer:
+            self.owner.spill()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.buffer:
+            self.owner.acquire(self).write(b"".join(self.buffer))
+            self.owner.buffered -= self.size
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        if not self.opened:
+            self.owner.acquire(self)
+        self.owner.release(self, final=True)
+
 
 class MultiZipHandle(object):
 
-    def __init__(self, mode="rb", **infiles):
+    def __init__(self, mode="rb", threads=1, max_open=0, **infiles):
         self.info = infiles
         self.handler = {}
         self.mode = mode
+        self.threads = threads
+        self.pool = None
+        self.max_open = max_open
+        self.lru = OrderedDict()
+        self.buffer_size = 1 << 20
+        self.max_buffer = 1 << 28
+        self.buffered = 0
+
+    def _open(self, f, mode):
+        if f.endswith(".gz"):
+            if "r" in mode:
+                return gzip.open(f, mode)
+            if self.pool is None:
+                self.pool = ThreadPool(max(self.threads, 1))
+            return BgzfWriter(f, mode, pool=self.pool)
+        return open(f, mode)
 
     def __enter__(self):
+        if self.max_open and len(self.info) > self.max_open and "r" not in self.mode:
+            for sn in self.info:
+                self.handler[sn] = PooledHandle(self, sn)
+            return self.handler
         for sn, f in self.info.items():
-            if f.endswith(".gz"):
-                self.handler[sn] = gzip.open(f, self.mode)
-            else:
-                self.handler[sn] = open(f, self.mode)
+            self.handler[sn] = self._open(f, self.mode)
         return self.handler
 
+    def acquire(self, ph):
+        if ph.handler is not None:
+            self.lru[ph.name] = self.lru.pop(ph.name)
+            return ph.handler
+        while len(self.lru) >= self.max_open:
+            self.release(next(iter(self.lru.values())))
+        ph.handler = self._open(self.info[ph.name], ph.opened and self.mode.replace(
+            "w", "a") or self.mode)
+        ph.opened = True
+        self.lru[ph.name] = ph
+        return ph.handler
+
+    def release(self, ph, final=False):
+        if ph.handler is None:
+            return
+        if isinstance(ph.handler, BgzfWriter):
+            ph.handler.close(eof=final)
+        else:
+            ph.handler.close()
+        ph.handler = None
+        self.lru.pop(ph.name, None)
+
+    def sync(self):
+        # flush everything to disk and return the file sizes
+        for h in self.handler.values():
+            h.flush()
+            if isinstance(h, PooledHandle) and h.handler is not None:
+                h.handler.flush()
+        return dict((f, os.path.isfile(f) and os.path.getsize(f) or 0) for f in self.info.values())
+
+    def spill(self):
+        for ph in sorted(self.handler.values(), key=lambda h: h.size, reverse=True):
+            if self.buffered <= self.max_buffer // 2:
+                break
+            ph.flush()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         for sn, h in self.handler.items():
             h.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def part_name(path, part):
+    # S1.R1.fq.gz -> S1.R1.part0001.fq.gz
+    base, ext = path, ""
+    for e in (".gz", ".fq"):
+        if base.endswith(e):
+            base, ext = base[:-len(e)], e + ext
+    return "%s.part%04d%s" % (base, part, ext)
+
+
+def record_offset(data, num, start=0):
+    # byte offset after num fastq records from start
+    for _ in range(num * 4):
+        start = data.index(b"\n", start) + 1
+    return start
+
+
+class PartHandle(PooledHandle):
+
+    def __init__(self, owner, name, path, lead=None):
+        PooledHandle.__init__(self, owner, name)
+        self.path = path
+        self.lead = lead
+        self.part = 1
+        self.reads = 0
+        self.nbytes = 0
+        self.cuts = []
+        owner.info[name] = part_name(path, 1)
+
+    def plan(self, data):
+        # (records, end offset) written before each roll over
+        cuts = []
+        start, reads, size = 0, self.owner.reads, self.owner.size
+        if reads:
+            left = data.count(b"\n") // 4
+            k = reads - self.reads
+            while k <= left:
+                start = record_offset(data, k, start)
+                cuts.append((k, start))
+                left -= k
+                k = reads
+            return cuts
+        need = size - self.nbytes
+        while len(data) - start >= need:
+            # the record holding the last byte of the part ends it
+            end = start + need - 1
+            lines = data.count(b"\n", start, end)
+            k = lines // 4 + 1
+            start = end
+            for _ in range(k * 4 - lines):
+                start = data.index(b"\n", start) + 1
+            cuts.append((k, start))
+            need = size
+        return cuts
+
+    def write(self, data):
+        if self.lead is None:
+            cuts = self.cuts = self.plan(data)
+        else:
+            cuts, start = [], 0
+            for k, _ in self.lead.cuts:
+                start = record_offset(data, k, start)
+                cuts.append((k, start))
+        start = 0
+        for k, end in cuts:
+            PooledHandle.write(self, data[start:end])
+            self.reads += k
+            self.roll()
+            start = end
+        if start < len(data):
+            rest = start and data[start:] or data
+            PooledHandle.write(self, rest)
+            self.reads += rest.count(b"\n") // 4
+            self.nbytes += len(rest)
+
+    def roll(self):
+        self.flush()
+        if not self.opened:
+            self.owner.acquire(self)
+        self.owner.release(self, final=True)
+        self.owner.finish(self.name, self.part, self.reads)
+        self.part += 1
+        self.reads = self.nbytes = 0
+        self.opened = False
+        self.owner.info[self.name] = part_name(self.path, self.part)
+
+    def close(self):
+        # a sample without reads still gets an empty first part
+        if self.reads or self.part == 1:
+            self.roll()
+
+
+class PartOutput(MultiZipHandle):
+
+    def __init__(self, reads=0, size=0, manifest=None, lead=None, mode="wb", threads=1, max_open=0, **outfiles):
+        MultiZipHandle.__init__(self, mode, threads, max_open or len(outfiles) + 1, **outfiles)
+        self.paths = dict(outfiles)
+        self.reads = reads
+        self.size = size
+        self.manifest = manifest
+        self.lead = lead
+
+    def __enter__(self):
+        for sn, f in self.paths.items():
+            self.handler[sn] = PartHandle(self, sn, f, self.lead and self.lead.handler[sn])
+        return self.handler
+
+    def finish(self, sn, part, reads):
+        if self.manifest is not None:
+            self.manifest.add(sn, part, reads, self.info[sn], self.lead is not None and 1 or 0)
+
+
+class PartManifest(object):
+
+    def __init__(self, path, mates=1):
+        self.path = path
+        self.mates = mates
+        self.parts = {}
+        with open(path, "w") as fo:
+            fo.write("sample\tpart\treads\t%s\n" % "\t".join(
+                "fastq%d" % (i + 1) for i in range(mates)))
+
+    def add(self, sn, part, reads, path, mate=0):
+        # a row is appended once all mates of the part are closed
+        files = self.parts.setdefault((sn, part), [None] * self.mates)
+        files[mate] = os.path.basename(path)
+        if None in files:
+            return
+        del self.parts[sn, part]
+        with open(self.path, "a") as fo:
+            fo.write("%s\t%d\t%d\t%s\n" % (sn, part, reads, "\t".join(files)))
+
+
+class PipeWriter(object):
+
+    # a thread per output, a slow reader only blocks the caller once its queue is full
+    def __init__(self, name, cmd=None, gz=False, queue=16, cwd=None):
+        self.name = name
+        self.cmd = cmd
+        self.gz = gz
+        self.cwd = cwd
+        self.queue = Queue(queue)
+        self.proc = None
+        self.handler = None
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _open(self):
+        if self.cmd:
+            self.proc = subprocess.Popen(
+                self.cmd, shell=True, stdin=subprocess.PIPE, cwd=self.cwd)
+            return self.proc.stdin
+        # opening a fifo waits for its reader
+        return open(self.name, "wb")
+
+    def _run(self):
+        data = b""
+        try:
+            self.handler = self._open()
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                if self.gz:
+                    data = b"".join(bgzf_block(data[i:i+BGZF_BLOCK_SIZE])
+                                    for i in range(0, len(data), BGZF_BLOCK_SIZE))
+                self.handler.write(data)
+            if self.gz:
+                self.handler.write(BGZF_EOF)
+            self.handler.close()
+        except (IOError, OSError) as e:
+            self.error = e
+            # keep draining so the writer never blocks on a dead reader
+            while data is not None:
+                data = self.queue.get()
+            try:
+                self.handler and self.handler.close()
+            except (IOError, OSError):
+                pass
+
+    def write(self, data):
+        if self.error is not None:
+            raise IOError("write %s failed: %s" % (self.cmd or self.name, self.error))
+        if data:
+            self.queue.put(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.proc is not None and self.proc.wait():
+            raise IOError("output command exit with code %d: %s" %
+                          (self.proc.returncode, self.cmd))
+        if self.error is not None:
+            raise IOError("write %s failed: %s" % (self.cmd or self.name, self.error))
+
+
+class PipeOutput(object):
+
+    def __init__(self, cmd=None, gz=False, cwd=None, **outfiles):
+        self.cmd = cmd
+        self.gz = gz
+        self.cwd = cwd
+        self.info = outfiles
+        self.handler = {}
+
+    def __enter__(self):
+        for sn, f in self.info.items():
+            cmd = self.cmd and self.cmd.replace(
+                "{sample}", sn).replace("{output}", f)
+            self.handler[sn] = PipeWriter(f, cmd, self.gz, cwd=self.cwd)
+        return self.handler
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        errors = []
+        for h in self.handler.values():
+            try:
+                h.close()
+            except IOError as e:
+                errors.append(e)
+        if errors and exc_type is None:
+            raise errors[0]
+
+
+def is_stream(path):
+    if path == "-":
+        return True
+    try:
+        return not stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+class GzipStream(io.RawIOBase):
+
+    # gzip read from a pipe, GzipFile of python2 seeks to the end of every member
+    def __init__(self, fileobj, size=1 << 16):
+        self.fileobj = fileobj
+        self.size = size
+        self.dec = zlib.decompressobj(31)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            data = self.dec.unconsumed_tail
+            if not data and self.dec.unused_data:
+                # next member of a multi member file, zeros after a member are padding
+                data = self.dec.unused_data.lstrip(b"\x00")
+                self.dec = zlib.decompressobj(31)
+            elif not data:
+                data = self.fileobj.read(self.size)
+                if not data:
+                    return 0
+            out = self.dec.decompress(data, len(b))
+            if out:
+                b[:len(out)] = out
+                return len(out)
 
 
 class Zopen(object):
@@ -49,12 +523,26 @@ class Zopen(object):
         self.mode = mode
         self.gzip = gzip
         self.handler = None
+        self.stream = None
+        self.proc = None
 
     def __enter__(self):
-        if self.name.endswith(".gz"):
+        if not self.name:
+            return None
+        if self.gzip and "r" in self.mode and is_stream(self.name):
+            # pipes can not be reopened, gzip is told from the magic bytes
+            if self.name == "-":
+                self.stream = io.open(sys.stdin.fileno(), "rb", closefd=False)
+            else:
+                self.stream = io.open(self.name, "rb")
+            self.handler = self.stream
+            if self.stream.peek(2)[:2] == b"\x1f\x8b":
+                self.handler = io.BufferedReader(GzipStream(self.stream))
+        elif self.name.endswith(".gz"):
             if self.gzip and "r" in self.mode:
                 p = subprocess.Popen(
                     ["gzip", "-c", "-d", self.name], stdout=subprocess.PIPE)
+                self.proc = p
                 self.handler = p.stdout
             else:
                 self.handler = gzip.open(self.name, self.mode)
@@ -65,6 +553,8 @@ class Zopen(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.handler:
             self.handler.close()
+        if self.stream:
+            self.stream.close()
 
 
 def canonicalize(path):
@@ -186,16 +676,19 @@ def is_exe(file_path):
     )
 
 
-def load_bcl_stats(j):
+def load_bcl_stats(j, rescued=None):
     with open(j) as fi:
         stat = json.load(fi)
-    info = stat["ConversionResults"][0]
-    out = []
-    for i in info["DemuxResults"]:
-        sn = i["SampleName"]
-        rdn = i["NumberReads"]
-        out.append((sn, rdn))
-    out.append(("Unknow", info["Undetermined"]["NumberReads"]))
+    rescued = rescued or {}
+    out = OrderedDict()
+    unknow = -sum(rescued.values())
+    for info in stat["ConversionResults"]:
+        for i in info["DemuxResults"]:
+            sn = i["SampleName"]
+            out[sn] = out.get(sn, 0) + i["NumberReads"]
+        unknow += info["Undetermined"]["NumberReads"]
+    out = [(sn, n + rescued.get(sn, 0)) for sn, n in out.items()]
+    out.append(("Unknow", unknow))
     return out
 
 
@@ -219,6 +712,37 @@ def is_ambiguous_dna(seq):
     return True
 
 
+def window_type(value):
+    try:
+        start, end = [int(i) for i in value.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid window '%s', use start:end" % value)
+    if start < 0 or end <= start:
+        raise argparse.ArgumentTypeError("invalid window '%s', need 0 <= start < end" % value)
+    return start, end
+
+
+def umi_type(value):
+    try:
+        start, num = [int(i) for i in value.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid umi '%s', use start:len" % value)
+    if start < 0 or num <= 0:
+        raise argparse.ArgumentTypeError("invalid umi '%s', need start >= 0 and len > 0" % value)
+    return start, num
+
+
+def size_type(value):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    try:
+        size = int(value[:-1]) * units[value[-1].upper()] if value[-1:].isalpha() else int(value)
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError("invalid size '%s', use bytes or K/M/G suffix" % value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("invalid size '%s', need > 0" % value)
+    return size
+
+
 def parseArg():
     parser = argparse.ArgumentParser(
         description="split a mix fastq or BCL by barcode index.",)
@@ -236,15 +760,21 @@ def parseArg():
     subparsers = parser.add_subparsers(
         metavar="command", dest="command")
     parser_index = subparsers.add_parser(
-        'index', parents=[parent1_parser, parent2_parser],  help="index fastq file for reading in multi processing, can be instead by `samtools fqidx <fqfile>`.")
+        'index', parents=[parent1_parser, parent2_parser],  help="build a random access checkpoint index (.fzi) of gzip fastq for split -t N, plain fastq needs no index.")
+    parser_index.add_argument("--span", help="uncompressed MB between gzip index checkpoints, 16 by default",
+                              type=int, default=16, metavar="<int>")
     parser_split = subparsers.add_parser(
         'split', parents=[parent2_parser], help="split sequence data by barcode.")
-    parser_split.add_argument("-i", "--input", type=str, help="input fastq file, required",
-                              required=True, metavar="<file>")
-    parser_split.add_argument("-I", "--Input", type=str, help="input paired fastq file",
+    parser_split.add_argument("-i", "--input", type=str, action="append", help="input fastq file, '-' for stdin, plain or gzip streams are detected, repeat for more inputs (lanes or runs) split into the same outputs, required unless --manifest",
+                              required=False, metavar="<file>")
+    parser_split.add_argument("-I", "--Input", type=str, action="append", help="input paired fastq file, repeat in the same order as -i",
                               required=False, metavar="<file>")
+    parser_split.add_argument("--manifest", type=str, help="input list file, one 'fastq1 [fastq2]' per line, relative paths from the manifest directory",
+                              metavar="<file>")
+    parser_split.add_argument("--input-jobs", help="inputs read at the same time when -t > 1, bounds concurrent decompressors, 2 by default",
+                              type=int, default=2, metavar="<int>")
     parser_split.add_argument("-b", "--barcode", type=str,
-                              help='sample and barcode sequence info, two or three columns like "sampleName barcodeSeq1 barcodeSeq2", required', required=True, metavar="<file>")
+                              help='sample and barcode sequence info, two or three columns like "sampleName barcodeSeq1 barcodeSeq2", or one barcode per line as sample name, required', required=True, metavar="<file>")
     parser_split.add_argument('-m', "--mismatch", help="mismatch allowed for barcode search, 0 by default",
                               type=int, default=0, metavar="<int>")
     parser_split.add_argument('-o', "--output", help="output directory, required",
@@ -256,7 +786,35 @@ def parseArg():
     parser_split.add_argument("-rc2", "--rc-bc2", action="store_true", default=False,
                               help='reverse complement barcode2')
     parser_split.add_argument("--output-gzip",   action='store_true',
-                              help="gzip output fastq file, this will make your process slower", default=False)
+                              help="gzip output fastq file in BGZF blocks, compressed in a thread pool", default=False)
+    parser_split.add_argument("--output-cmd", type=str,
+                              help="pipe each sample into this shell command (run in the output directory) instead of a file, '{sample}' and '{output}' are replaced by the sample name and output path, paired reads are interleaved", metavar="<str>")
+    parser_split.add_argument('-t', "--threads", help="worker processes for barcode matching, 1 by default",
+                              type=int, default=1, metavar="<int>")
+    parser_split.add_argument("--max-open", help="max output files kept open at the same time, others are buffered and reopened in append mode, 1000 by default",
+                              type=int, default=1000, metavar="<int>")
+    parser_split.add_argument("--shard-reads", type=int,
+                              help="roll each sample output over to numbered parts of this many reads, like sn.part0001.fq.gz, R2 parts hold the mates of R1 parts, finished parts are listed in parts.tsv of the output directory", metavar="<int>")
+    parser_split.add_argument("--shard-bytes", type=size_type,
+                              help="roll each sample output over to numbered parts once R1 reaches this uncompressed size, K/M/G suffix allowed, ends at a record boundary, exclusive with --shard-reads", metavar="<size>")
+    parser_split.add_argument("--qc", action="store_true", default=False,
+                              help="compute per sample read, length, per cycle base, quality and barcode mismatch statistics while splitting, written to qc.json of the output directory (numpy required)")
+    parser_split.add_argument("--checkpoint", help="seconds between checkpoints of written records, output sizes and counts saved in checkpoint.json of the output directory, 600 by default, 0 disables",
+                              type=int, default=600, metavar="<int>")
+    parser_split.add_argument("--resume", action="store_true", default=False,
+                              help="resume a killed run from checkpoint.json, outputs are truncated to the checkpoint and inputs skipped ahead")
+    parser_split.add_argument("--profile", action="store_true", default=False,
+                              help="log per stage timing and periodic progress")
+    parser_split.add_argument("--report", type=str,
+                              help="write a json run report with stage timing, throughput and sample counts, implies --profile", metavar="<file>")
+    parser_split.add_argument("--engine", choices=["python", "numpy", "whitelist"], default="python",
+                              help="barcode matching engine, 'numpy' matches reads in vectorized batches, 'whitelist' uses a packed index cached beside the barcode file for large barcode lists, 'python' by default")
+    parser_split.add_argument("--barcode-source", choices=["sequence", "header"], default="sequence",
+                              help="where to read barcodes, 'header' matches the index 'i7+i5' at the end of the read header comment (i5 only with three column barcode file) and writes records unchanged, 'sequence' by default")
+    parser_split.add_argument("--barcode-window", type=window_type,
+                              help="search barcode anywhere inside read bases start:end (0-based, end exclusive), the lowest mismatch and then leftmost hit wins, -d trims through the barcode end", metavar="<start:end>")
+    parser_split.add_argument("--umi", type=umi_type,
+                              help="cut a UMI of len bases starting start bases after the barcode end from R1 and append it to the read name of R1 and R2 as 'name_UMI', -d also trims the barcode", metavar="<start:len>")
     parser_bcl2fq = subparsers.add_parser(
         'bcl2fq', parents=[parent1_parser, parent2_parser], help="split flowcell bcl data to fastq.")
     parser_bcl2fq.add_argument('-t', "--threads", help="threads core, 10 by default",
@@ -275,4 +833,12 @@ def parseArg():
                                help="barcode mode, single-end or paired-end sequence, 'auto' by default")
     parser_bcl2fq.add_argument('--bcl2fq', metavar="<str>",
                                help="bcl2fastq path if necessary, if not set, auto detected")
+    parser_bcl2fq.add_argument('-j', "--jobs", help="run bcl2fastq as this many parallel processes on lane/tile partitions of the flowcell, sharing --threads cores, 1 by default (one process for the whole flowcell)",
+                               type=int, default=1, metavar="<int>")
+    parser_bcl2fq.add_argument("--retries", help="retry times of a failed bcl2fastq partition when --jobs > 1, 2 by default",
+                               type=int, default=2, metavar="<int>")
+    parser_bcl2fq.add_argument("--rescue", help="after bcl2fastq, assign Undetermined reads whose header index is within this many mismatches of only one sample, and append them to the sample fastq, off by default",
+                               type=int, metavar="<int>")
+    parser_bcl2fq.add_argument("--engine", choices=["bcl2fastq", "bcl"], default="bcl2fastq",
+                               help="demultiplexing engine, 'bcl' reads bcl/cbcl files natively without bcl2fastq (numpy required), 'bcl2fastq' by default")
     return parser.parse_args()
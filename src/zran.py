@@ -0,0 +1,372 @@
+import io
+import ctypes
+import ctypes.util
+
+from .utils import *
+
+ZRAN_MAGIC = b"FZRAN"
+ZRAN_VERSION = 1
+ZRAN_SPAN = 1 << 24
+WINSIZE = 32768
+CHUNK = 1 << 18
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+ZRAN_HEAD = struct.Struct("<5sHQdQIQQ")
+ZRAN_POINT = struct.Struct("<QQBQQQI")
+
+_libz = None
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def libz():
+    global _libz
+    if _libz is None:
+        name = ctypes.util.find_library("z")
+        if not name:
+            raise IOError("zlib shared library not found")
+        lib = ctypes.CDLL(name)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        for f in ("inflateInit2_", "inflate", "inflateEnd", "inflateReset",
+                  "inflateReset2", "inflatePrime", "inflateSetDictionary"):
+            getattr(lib, f).restype = ctypes.c_int
+        _libz = lib
+    return _libz
+
+
+class Inflater(object):
+
+    def __init__(self, wbits=47, outsize=WINSIZE):
+        self.lib = libz()
+        self.strm = ZStream()
+        self.strm_p = ctypes.byref(self.strm)
+        self.out = ctypes.create_string_buffer(outsize)
+        self.outsize = outsize
+        self.data = b""
+        ret = self.lib.inflateInit2_(self.strm_p, wbits, self.lib.zlibVersion(),
+                                     ctypes.sizeof(ZStream))
+        self.check(ret)
+
+    def check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            msg = self.strm.msg and self.strm.msg.decode() or ret
+            raise IOError("zlib inflate error: %s" % msg)
+        return ret
+
+    def feed(self, data):
+        self.data = data
+        self.strm.next_in = ctypes.cast(
+            ctypes.c_char_p(data), ctypes.c_void_p)
+        self.strm.avail_in = len(data)
+
+    @property
+    def unused(self):
+        return self.data[len(self.data)-self.strm.avail_in:]
+
+    def skip(self, n):
+        self.feed(self.unused[n:])
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        if self.strm.avail_out == 0:
+            self.strm.next_out = ctypes.addressof(self.out)
+            self.strm.avail_out = self.outsize
+        start = self.outsize - self.strm.avail_out
+        ret = self.check(self.lib.inflate(self.strm_p, flush))
+        end = self.outsize - self.strm.avail_out
+        return ret, ctypes.string_at(ctypes.addressof(self.out) + start, end - start)
+
+    def window(self):
+        left = self.strm.avail_out
+        raw = self.out.raw
+        return raw[self.outsize-left:] + raw[:self.outsize-left]
+
+    def prime(self, bits, value):
+        self.check(self.lib.inflatePrime(self.strm_p, bits, value))
+
+    def set_dictionary(self, window):
+        self.check(self.lib.inflateSetDictionary(
+            self.strm_p, window, len(window)))
+
+    def reset(self, wbits=None):
+        if wbits is None:
+            self.check(self.lib.inflateReset(self.strm_p))
+        else:
+            self.check(self.lib.inflateReset2(self.strm_p, wbits))
+
+    def close(self):
+        if self.lib is not None:
+            self.lib.inflateEnd(self.strm_p)
+            self.lib = None
+
+    def __del__(self):
+        self.close()
+
+
+class GzipIndex(object):
+
+    def __init__(self, fastqfile="", span=ZRAN_SPAN):
+        self.fq = os.path.abspath(fastqfile)
+        self.idx = self.fq + ".fzi"
+        self.span = span
+        self.points = []
+        self.size = 0
+        self.mtime = 0.0
+        self.total_out = 0
+        self.nrec = 0
+
+    def build(self):
+        st = os.stat(self.fq)
+        self.size, self.mtime = st.st_size, st.st_mtime
+        points = []
+        pending = []
+        inf = Inflater(47)
+        totin = totout = last = 0
+        nl = 0
+        with open(self.fq, "rb") as fi:
+            while True:
+                if inf.strm.avail_in == 0:
+                    data = fi.read(CHUNK)
+                    if not data:
+                        break
+                    inf.feed(data)
+                ain = inf.strm.avail_in
+                ret, out = inf.inflate(Z_BLOCK)
+                totin += ain - inf.strm.avail_in
+                if pending and out:
+                    nl = self._align(pending, points, out, totout, nl)
+                else:
+                    nl += out.count(b"\n")
+                totout += len(out)
+                if ret == Z_STREAM_END:
+                    rest = inf.unused or fi.read(CHUNK)
+                    if not rest.startswith(b"\x1f\x8b"):
+                        break
+                    inf.reset()
+                    inf.feed(rest)
+                    continue
+                dt = inf.strm.data_type
+                if dt & 128 and not dt & 64 and (totout == 0 or totout - last > self.span):
+                    if nl % 4 == 0 and (totout == 0 or self._last_byte(inf) == b"\n"):
+                        need = 0
+                    else:
+                        need = (nl // 4 + 1) * 4 - nl
+                    point = [totout, totin, dt & 7, inf.window(), totout,
+                             (nl + need) // 4, need]
+                    if need == 0:
+                        points.append(point)
+                    else:
+                        pending.append(point)
+                    last = totout
+        inf.close()
+        self.points = [tuple(p[:6]) for p in points]
+        self.total_out = totout
+        self.nrec = nl // 4
+        self.logs.info("create gzip index (%s) with %d access points done.",
+                       self.idx, len(self.points))
+        return self
+
+    @staticmethod
+    def _last_byte(inf):
+        pos = (inf.outsize - inf.strm.avail_out) or inf.outsize
+        return inf.out.raw[pos-1:pos]
+
+    def _align(self, pending, points, out, base, nl):
+        start = 0
+        while pending:
+            point = pending[0]
+            while point[6]:
+                p = out.find(b"\n", start)
+                if p < 0:
+                    break
+                start = p + 1
+                nl += 1
+                point[6] -= 1
+            if point[6]:
+                break
+            point[4] = base + start
+            points.append(pending.pop(0))
+        return nl + out.count(b"\n", start)
+
+    def save(self):
+        with open(self.idx, "wb") as fo:
+            fo.write(ZRAN_HEAD.pack(ZRAN_MAGIC, ZRAN_VERSION, self.size, self.mtime,
+                                    self.span, len(self.points), self.total_out, self.nrec))
+            windows = []
+            for out, inp, bits, window, rstart, rec in self.points:
+                window = zlib.compress(window)
+                windows.append(window)
+                fo.write(ZRAN_POINT.pack(out, inp, bits,
+                         rstart, rec, 0, len(window)))
+            for window in windows:
+                fo.write(window)
+
+    def load(self):
+        with open(self.idx, "rb") as fi:
+            head = fi.read(ZRAN_HEAD.size)
+            if len(head) < ZRAN_HEAD.size:
+                raise IOError("truncated gzip index %s" % self.idx)
+            magic, version, size, mtime, span, npoints, total_out, nrec = ZRAN_HEAD.unpack(
+                head)
+            if magic != ZRAN_MAGIC or version != ZRAN_VERSION:
+                raise IOError("unsupported gzip index %s (version %s)" %
+                              (self.idx, version))
+            self.size, self.mtime, self.span = size, mtime, span
+            self.total_out, self.nrec = total_out, nrec
+            offset = ZRAN_HEAD.size + ZRAN_POINT.size * npoints
+            self.points = []
+            for _ in range(npoints):
+                out, inp, bits, rstart, rec, flags, wlen = ZRAN_POINT.unpack(
+                    fi.read(ZRAN_POINT.size))
+                self.points.append(
+                    (out, inp, bits, (offset, wlen), rstart, rec))
+                offset += wlen
+        return self
+
+    def is_valid(self):
+        if not os.path.isfile(self.idx):
+            return False
+        st = os.stat(self.fq)
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def window(self, i):
+        window = self.points[i][3]
+        if isinstance(window, bytes):
+            return window
+        offset, n = window
+        with open(self.idx, "rb") as fi:
+            fi.seek(offset)
+            return zlib.decompress(fi.read(n))
+
+    def point(self, rec):
+        lo, hi = 0, len(self.points) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.points[mid][5] <= rec:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def open(self, i=0):
+        return io.BufferedReader(ZranReader(self, i), CHUNK)
+
+    def slices(self):
+        recs = [p[5] for p in self.points] + [self.nrec]
+        return [(s, e - s) for s, e in zip(recs[:-1], recs[1:]) if e > s]
+
+    @classmethod
+    def create(cls, fq="", span=ZRAN_SPAN):
+        gzi = cls(fq, span).build()
+        gzi.save()
+        return gzi
+
+    @classmethod
+    def fromfile(cls, fq=""):
+        gzi = cls(fq)
+        if not os.path.isfile(gzi.idx):
+            return None
+        try:
+            gzi.load()
+        except (IOError, struct.error) as e:
+            gzi.logs.warning("ignore gzip index: %s", e)
+            return None
+        if not gzi.is_valid():
+            gzi.logs.warning(
+                "gzip index %s is out of date, rebuild it by `fsplit index`", gzi.idx)
+            return None
+        return gzi
+
+    @property
+    def logs(self):
+        return logging.getLogger()
+
+
+class ZranReader(io.RawIOBase):
+
+    def __init__(self, gzi, i=0):
+        out, inp, bits, window, rstart, rec = gzi.points[i]
+        self.fh = open(gzi.fq, "rb")
+        self.fh.seek(inp - (bits and 1 or 0))
+        self.inf = Inflater(-15, CHUNK)
+        if bits:
+            self.inf.prime(bits, ord(self.fh.read(1)) >> (8 - bits))
+        self.inf.set_dictionary(gzi.window(i))
+        self.raw = True
+        self.skip = rstart - out
+        self.buf = b""
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while not self.buf and not self.eof:
+            if self.inf.strm.avail_in == 0:
+                data = self.fh.read(CHUNK)
+                if not data:
+                    self.eof = True
+                    break
+                self.inf.feed(data)
+            ret, out = self.inf.inflate()
+            if self.skip:
+                n = min(self.skip, len(out))
+                out = out[n:]
+                self.skip -= n
+            self.buf = out
+            if ret == Z_STREAM_END:
+                self._next_member()
+
+    def _next_member(self):
+        if self.raw:
+            trailer = 8
+            while len(self.inf.unused) < trailer:
+                data = self.fh.read(CHUNK)
+                if not data:
+                    break
+                self.inf.feed(self.inf.unused + data)
+            self.inf.skip(trailer)
+        rest = self.inf.unused or self.fh.read(CHUNK)
+        if len(rest) < 2:
+            rest += self.fh.read(CHUNK)
+        if not rest.startswith(b"\x1f\x8b"):
+            self.eof = True
+            return
+        self.raw = False
+        self.inf.reset(31)
+        self.inf.feed(rest)
+
+    def readinto(self, b):
+        self._fill()
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.inf.close()
+            self.fh.close()
+        super(ZranReader, self).close()